@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+#
+#
+# Command line entry point:
+#
+#           python3 -m syzygy run script.txt --steps N --dt X --record out/
+#           python3 -m syzygy sweep template.txt --param G=1,2 --steps N --dt X --out out/
+#           python3 -m syzygy bench --out results.json [--compare baseline.json]
+#
+# Runs are headless; nothing here imports matplotlib. Running a cached 
+# simulation doesn't import the parser either, so `bench` and `sweep` (which 
+# do) are imported by their commands.
+
+import argparse
+import json
+import os
+import sys
+
+from syzygy import runner
+from syzygy.sim import profiling
+from syzygy.sim import sim_state
+
+
+def simulation_options(args):
+    """`SimState` options given on the command line."""
+    options = {}
+    if args.dtype is not None:
+        options["dtype"] = args.dtype
+    if args.accumulator_dtype is not None:
+        options["accumulator_dtype"] = args.accumulator_dtype
+    if args.vector_kernels:
+        options["vector_kernels"] = True
+    if args.fuse_pair_forces:
+        options["fuse_pair_forces"] = True
+    return options
+
+
+def add_simulation_arguments(parser):
+    parser.add_argument("--dtype", default=None, 
+                        choices=["float32", "float64", "longdouble"],
+                        help="Precision of the simulation data (default: float64).")
+    parser.add_argument("--accumulator-dtype", default=None, 
+                        choices=["float32", "float64", "longdouble"],
+                        help="Precision in which forces are summed.")
+    parser.add_argument("--vector-kernels", action="store_true",
+                        help="Compile each vector rule to one function.")
+    parser.add_argument("--fuse-pair-forces", action="store_true",
+                        help="Compile all pair forces to one function.")
+
+
+def script_dir(path):
+    """The directory files named in the script at `path` are read from."""
+    return os.path.dirname(os.path.abspath(path))
+
+
+def run_command(args):
+    with open(args.script, "r") as reader:
+        script = reader.read()
+
+    startup_report = profiling.StartupReport() if args.startup_report else None
+    state = sim_state.create_simulation(script, args.backend, cache_dir=args.cache_dir,
+                                        startup_report=startup_report, 
+                                        script_dir=script_dir(args.script),
+                                        **simulation_options(args))
+    if startup_report is not None:
+        print(startup_report)
+    if args.profile:
+        state.enable_profiling()
+    summary = runner.run(state, args.dt, args.steps,
+                         record_dir=args.record,
+                         record_every=args.record_every)
+
+    print(f"{summary['steps']} steps of {summary['num_particles']} particles "
+          f"in {summary['elapsed']:.3f}s "
+          f"({summary['steps_per_second']:.1f} steps/s)")
+    if args.profile:
+        print(state.profile())
+
+
+def sweep_command(args):
+    from syzygy import sweep
+
+    with open(args.template, "r") as reader:
+        template = reader.read()
+
+    grid = {}
+    if args.grid is not None:
+        with open(args.grid, "r") as reader:
+            grid.update(json.load(reader))
+    for param in args.param:
+        name, values = sweep.parse_param(param)
+        grid[name] = values
+
+    def report(result):
+        if result["status"] == "ok":
+            print(f"{result['id']} {result['params']}: "
+                  f"{result['steps_per_second']:.1f} steps/s")
+        else:
+            print(f"{result['id']} {result['params']}: failed")
+            print(result["error"], file=sys.stderr)
+
+    results = sweep.sweep(template, grid, args.out,
+                          dt=args.dt,
+                          steps=args.steps,
+                          backend=args.backend,
+                          record=not args.no_record,
+                          record_every=args.record_every,
+                          workers=args.workers,
+                          on_result=report,
+                          script_dir=script_dir(args.template))
+    failed = sum(result["status"] != "ok" for result in results)
+    print(f"{len(results)} runs, {failed} failed")
+    return 1 if failed else 0
+
+
+def bench_command(args):
+    from syzygy import bench
+
+    for scene in args.scenes or []:
+        if scene not in bench.SCENES:
+            print(f"Unknown scene \"{scene}\" (choose from "
+                  f"{', '.join(sorted(bench.SCENES))})", file=sys.stderr)
+            return 2
+
+    if args.current is not None:
+        with open(args.current, "r") as reader:
+            current = json.load(reader)
+    else:
+        def report(result):
+            print(f"{result['scene']:>8} {result['num_particles']:>7} {result['backend']:>16}: "
+                  f"parse {result['parse_time']:.3f}s, "
+                  f"compile {result['compile_time']:.3f}s, "
+                  f"{result['steps_per_second']:.1f} steps/s, "
+                  f"peak {result.get('peak_memory', 0) / 2**20:.1f} MiB")
+
+        current = bench.run_benchmarks(scenes=args.scenes,
+                                       sizes=args.sizes,
+                                       backends=args.backends,
+                                       steps=args.steps,
+                                       max_seconds=args.max_seconds,
+                                       trace_memory=not args.no_memory,
+                                       imports=not args.no_imports,
+                                       on_result=report,
+                                       **simulation_options(args))
+        if "imports" in current:
+            imports = current["imports"]
+            print(f"imports: sim_state {imports['import_time']:.3f}s, "
+                  f"load and step {imports['load_time']:.3f}s")
+
+    if args.out is not None:
+        with open(args.out, "w") as writer:
+            json.dump(current, writer, indent=2)
+
+    eager_imports = current.get("imports", {}).get("eager_imports", [])
+    for name in eager_imports:
+        print(f"EAGER IMPORT {name}")
+
+    if args.compare is None:
+        return 1 if eager_imports else 0
+
+    with open(args.compare, "r") as reader:
+        baseline = json.load(reader)
+    regressions = bench.compare(baseline, current, threshold=args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression['scene']} {regression['num_particles']} "
+              f"{regression['backend']} {regression['metric']}: "
+              f"{regression['baseline']:.4g} -> {regression['current']:.4g} "
+              f"({100 * regression['change']:+.1f}%)")
+    print(f"{len(regressions)} regressions")
+    return 1 if regressions or eager_imports else 0
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="syzygy")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run a script headlessly.")
+    run_parser.add_argument("script", help="Path to a syzygy script.")
+    run_parser.add_argument("--steps", type=int, required=True,
+                            help="Number of steps.")
+    run_parser.add_argument("--dt", type=float, required=True,
+                            help="Time elapsed between steps.")
+    run_parser.add_argument("--backend", default="python-lambdas",
+                            choices=sorted(sim_state.SIM_STATE_CLASSES),
+                            help="SimState backend.")
+    run_parser.add_argument("--record", default=None, metavar="DIR",
+                            help="Write trajectories to DIR.")
+    run_parser.add_argument("--record-every", type=int, default=1, metavar="K",
+                            help="Record positions once every K steps.")
+    run_parser.add_argument("--cache-dir", default=None, metavar="DIR",
+                            help="Reuse compiled simulations cached in DIR.")
+    add_simulation_arguments(run_parser)
+    run_parser.add_argument("--profile", action="store_true",
+                            help="Report the time spent in each force and update rule.")
+    run_parser.add_argument("--startup-report", action="store_true",
+                            help="Report the time spent building the simulation.")
+    run_parser.set_defaults(func=run_command)
+
+    sweep_parser = subparsers.add_parser("sweep", help="Run a parameter sweep.")
+    sweep_parser.add_argument("template", 
+                              help="Path to a script with $name placeholders.")
+    sweep_parser.add_argument("--param", action="append", default=[], 
+                              metavar="NAME=V1,V2,...",
+                              help="A grid dimension. May be repeated.")
+    sweep_parser.add_argument("--grid", default=None, metavar="JSON",
+                              help="A JSON file mapping names to lists of values.")
+    sweep_parser.add_argument("--out", required=True, metavar="DIR",
+                              help="Output directory. Re-running resumes the sweep.")
+    sweep_parser.add_argument("--steps", type=int, default=None,
+                              help="Number of steps (unless in the grid).")
+    sweep_parser.add_argument("--dt", type=float, default=None,
+                              help="Time elapsed between steps (unless in the grid).")
+    sweep_parser.add_argument("--backend", default="python-lambdas",
+                              choices=sorted(sim_state.SIM_STATE_CLASSES),
+                              help="SimState backend.")
+    sweep_parser.add_argument("--workers", type=int, default=None,
+                              help="Number of worker processes.")
+    sweep_parser.add_argument("--no-record", action="store_true",
+                              help="Don't record positions.")
+    sweep_parser.add_argument("--record-every", type=int, default=1, metavar="K",
+                              help="Record positions once every K steps.")
+    sweep_parser.set_defaults(func=sweep_command)
+
+    bench_parser = subparsers.add_parser("bench", help="Run the benchmarks.")
+    bench_parser.add_argument("--scenes", nargs="+", default=None,
+                              help="Scenes to benchmark (default: all).")
+    bench_parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100],
+                              help="Numbers of particles.")
+    bench_parser.add_argument("--backends", nargs="+", default=None,
+                              choices=sorted(sim_state.SIM_STATE_CLASSES),
+                              help="Backends to benchmark (default: all).")
+    bench_parser.add_argument("--steps", type=int, default=100,
+                              help="Maximum number of steps per benchmark.")
+    bench_parser.add_argument("--max-seconds", type=float, default=5.0,
+                              help="Maximum stepping time per benchmark.")
+    bench_parser.add_argument("--no-memory", action="store_true",
+                              help="Skip the peak memory measurement.")
+    bench_parser.add_argument("--no-imports", action="store_true",
+                              help="Skip the import time measurement.")
+    add_simulation_arguments(bench_parser)
+    bench_parser.add_argument("--out", default=None, metavar="JSON",
+                              help="Write the results to JSON.")
+    bench_parser.add_argument("--current", default=None, metavar="JSON",
+                              help="Use stored results instead of running.")
+    bench_parser.add_argument("--compare", default=None, metavar="BASELINE",
+                              help="Flag regressions against stored results.")
+    bench_parser.add_argument("--threshold", type=float, default=0.2,
+                              help="Relative change that counts as a regression.")
+    bench_parser.set_defaults(func=bench_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,71 @@
 # See https://matplotlib.org/stable/api/animation_api.html for info on 
 # matplotlib's animation scheme.
 
-from syzygy.sim.sim_state import SimState
+#
+# matplotlib is imported when the first figure is created, so importing this 
+# module (e.g. for `scatter_style` or `TrailBuffer`) stays cheap.
+
+from syzygy.sim.sim_state import SimState, SimulationBuilder
+from syzygy import producer
 
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib.animation as animation
-import matplotlib.axes
+
+
+def pyplot():
+    """`matplotlib.pyplot`, imported on first use."""
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
+def scatter_style(state, markersize=8):
+    """
+    Keyword arguments for `Axes3D.scatter` giving each particle its own color 
+    and size. Particles may define a `color` property (a scalar, mapped 
+    through the colormap, or an RGB triple in [0, 1]) and a `size` property 
+    (marker diameter in points). Otherwise every particle is drawn with 
+    `markersize`.
+    """
+    layout = state.data_layout
+    prop_names = layout.particle_metadata.prop_name_to_idx
+    style = {"s": markersize ** 2}
+    if "size" in prop_names:
+        style["s"] = layout.prop_view(state.data(), "size")[:, 0] ** 2
+    if "color" in prop_names:
+        color = np.array(layout.prop_view(state.data(), "color"))
+        style["c"] = color[:, 0] if color.shape[1] == 1 else color
+    return style
+
+
+class TrailBuffer:
+    """
+    The last `length` positions of every particle, stored in one 
+    preallocated ring buffer. Each frame is written twice (slots k and 
+    k + length), so the `length` most recent frames are always a contiguous, 
+    time-ordered window of the buffer. The `length` possible windows are 
+    made once, so `segments` neither copies nor allocates.
+    """
+    def __init__(self, length, positions):
+        if length < 2:
+            raise ValueError("Trails need a length of at least 2")
+        self._length = length
+        self._buffer = np.empty((2 * length,) + positions.shape, dtype=positions.dtype)
+        # Trails start collapsed onto the initial positions.
+        self._buffer[:] = positions
+        self._oldest = 0
+        self._windows = [self._buffer[k:k + length].swapaxes(0, 1) 
+                         for k in range(length)]
+
+
+    def push(self, positions):
+        """Overwrite the oldest frame with `positions`."""
+        self._buffer[self._oldest] = positions
+        self._buffer[self._oldest + self._length] = positions
+        self._oldest = (self._oldest + 1) % self._length
+
+
+    def segments(self):
+        """A (num_particles, length, dim) view of the trails, oldest first."""
+        return self._windows[self._oldest]
 
 
 # Next steps:
@@ -16,24 +74,42 @@ import matplotlib.axes
 #   it possible to pause, resume, load and save states, etc.
 
 class Simulation:
-    def __init__(self, dt, steps_per_update, state: SimState):
-        self._fig = plt.figure()
+    def __init__(self, dt, steps_per_update, state: SimState, builder=None):
+        """
+        Args
+            builder: The `SimulationBuilder` that built `state`, if any. 
+            Reloads are compiled with it.
+        """
+        self._fig = pyplot().figure()
         self._ax = self._fig.add_subplot(projection='3d')
         self._dt = dt
         self._steps_per_update = steps_per_update
         self._state = state
+        self._builder = builder
         self._paused = False
+        # Background simulation thread (see `create_animation(threaded=True)`)
+        self._producer = None
         # Configure event handlers (this will eventually be done in its own function).
         self._fig.canvas.mpl_connect("button_press_event", self._toggle_pause)
 
     def _toggle_pause(self, event):
         if self._paused:
             self._animation.resume()
+            if self._producer is not None:
+                self._producer.resume()
         else:
             self._animation.pause()
+            if self._producer is not None:
+                self._producer.pause()
         self._paused = not self._paused
 
 
+    def _stop_producer(self, event=None):
+        if self._producer is not None:
+            self._producer.stop()
+            self._producer = None
+
+
     def config_fig(self):
         # A `matplotlib.patches.Patch` is a 2D artist with a face color and an 
         # edge color.
@@ -42,7 +118,7 @@ class Simulation:
     def config_bg(self):
       # TODO Ideally this should read from a config file.
       self._ax.set_axis_off()
-      plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+      pyplot().subplots_adjust(left=0, right=1, top=1, bottom=0)
 
     def config_plot_limits(self, xlim, ylim, zlim, origin=(0,0,0)):
         # Center the plot at `origin`
@@ -50,37 +126,124 @@ class Simulation:
         self._ax.set(ylim3d=(ylim[0] + origin[1], ylim[1] + origin[1]))
         self._ax.set(zlim3d=(zlim[0] + origin[2], zlim[1] + origin[2]))
 
-    def create_animation(self):
-        # Initialize point objects.
-        num_points = self._state.data_layout.num_particles()
-        points = [self._ax.plot([], [], [], 'o', markersize=8)[0] for _ in range(num_points)]
-
-        # Function to update the animation
-        def update(frame):
+    def create_animation(self, threaded=False, buffer_size=8, interval=50,
+                         trail_length=0, trail_every=1):
+        """
+        Args
+            threaded: If True, the simulation runs on a background thread 
+            and publishes frames to a ring buffer of `buffer_size` frames. 
+            Each animation frame draws the latest published frame (if any), 
+            so slow physics doesn't freeze the UI and slow rendering doesn't 
+            stall the physics.
+            buffer_size: See `threaded`.
+            interval: Delay between animation frames in milliseconds.
+            trail_length: If at least 2, draw a trail through each particle's 
+            last `trail_length` recorded positions.
+            trail_every: Record a trail position once every `trail_every` 
+            drawn frames.
+        """
+        import matplotlib.animation as animation
+        from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+        # All particles are drawn by a single artist.
+        positions = self._state.positions_view()
+        style = scatter_style(self._state)
+        points = self._ax.scatter(positions[:, 0], positions[:, 1], positions[:, 2], 
+                                  depthshade=False, **style)
+
+        artists = (points,)
+
+        # Trails are drawn by a single line collection.
+        trails = None
+        if trail_length >= 2:
+            trails = TrailBuffer(trail_length, positions)
+            trail_lines = Line3DCollection(trails.segments(), linewidths=1, alpha=0.5)
+            self._ax.add_collection(trail_lines)
+            artists = (points, trail_lines)
+        drawn = 0
+
+        def draw(positions):
+            nonlocal drawn
+            points.set_offsets(positions[:, :2])
+            # `set_3d_properties` keeps the sizes it finds, which the last 
+            # draw left sorted by depth, so give each particle its own again.
+            points.set_sizes(np.atleast_1d(style["s"]))
+            points.set_3d_properties(positions[:, 2], "z")
+            if trails is not None:
+                if drawn % trail_every == 0:
+                    trails.push(positions)
+                    trail_lines.set_segments(trails.segments())
+                drawn += 1
+            return artists
+
+        # Step and draw, in this thread.
+        def step_and_draw(frame):
             self._state.step(self._dt / self._steps_per_update, frame, 
                               steps=self._steps_per_update)
-            for i, data in enumerate(self._state.positions()):
-                points[i].set_data_3d(np.expand_dims(data, axis=1))
-            return points
+            return draw(self._state.positions_view())
+
+        if threaded:
+            self._stop_producer()
+            ring = producer.FrameRing(buffer_size, positions.shape, positions.dtype)
+            self._producer = producer.SimulationProducer(
+                    self._state, 
+                    self._dt / self._steps_per_update, 
+                    self._steps_per_update, 
+                    ring, 
+                    min_frame_interval=interval / 1000)
+            latest = np.zeros_like(positions)
+            last_seq = -1
+
+            # Draw the latest frame. Frames published since the last call are 
+            # dropped.
+            def draw_latest(frame):
+                nonlocal last_seq
+                published = ring.latest(latest)
+                if published is None or published[0] == last_seq:
+                    return artists
+                last_seq = published[0]
+                return draw(latest)
+
+            self._fig.canvas.mpl_connect("close_event", self._stop_producer)
+            self._producer.start()
 
+        # Function to update the animation
+        update = draw_latest if threaded else step_and_draw
         self._animation = animation.FuncAnimation(
                 self._fig, 
                 update, 
                 frames=np.arange(0, 10000), 
-                interval=50, 
+                interval=interval, 
                 blit=True, 
                 repeat=True)
 
+    def reload(self, script):
+        """
+        Switch to an edited script without restarting (see 
+        `SimState.reload`). The number of particles must stay the same.
+        """
+        if self._builder is None:
+            # Later reloads only recompile what changed.
+            self._builder = SimulationBuilder()
+        if self._producer is not None:
+            self._producer.reload(script, self._builder)
+            return
+        new_state = self._state.prepare_reload(script, self._builder)
+        if new_state.positions_view().shape != self._state.positions_view().shape:
+            raise ValueError("Reloading a running simulation can't change its "
+                             "number of particles")
+        self._state.apply_reload(new_state)
+
     def resume_animation(self):
         self._animation.event_source.resume()
 
     def pause_animation(self):
         self._animation.event_source.pause()
 
-    def save_state(self):
-        state_writer = open("data/current_state.json", "w")
-        state_writer.write(self._state.to_json())
+    def save_state(self, path="data/current_state.ckpt"):
+        # Resume with `SimState.restore(path)`.
+        self._state.checkpoint(path)
 
     def run_animation(self):
         # To be expanded on.
-        plt.show()
+        pyplot().show()
@@ -6,12 +6,9 @@
 # An version of the simulation class that uses matplotlib's default backend.
 
 from syzygy.sim.sim_state import SimState
+from syzygy.anim import pyplot, scatter_style
 
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib.animation as animation
-import matplotlib.axes
 
 
 # Next steps:
@@ -21,7 +18,7 @@ import matplotlib.axes
 
 class Simulation:
     def __init__(self, dt, steps_per_update, state: SimState):
-        self._fig = plt.figure()
+        self._fig = pyplot().figure()
         self._ax = self._fig.add_subplot(projection='3d')
         self._dt = dt
         self._steps_per_update = steps_per_update
@@ -46,7 +43,7 @@ class Simulation:
     def config_bg(self):
       # TODO Ideally this should read from a config file.
       self._ax.set_axis_off()
-      plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+      pyplot().subplots_adjust(left=0, right=1, top=1, bottom=0)
 
     def config_plot_limits(self, xlim, ylim, zlim, origin=(0,0,0)):
         # Center the plot at `origin`
@@ -55,17 +52,23 @@ class Simulation:
         self._ax.set(zlim3d=(zlim[0] + origin[2], zlim[1] + origin[2]))
 
     def create_animation(self):
-        # Initialize point objects.
-        num_points = self._state.data_layout.num_particles()
-        points = [self._ax.plot([], [], [], 'o', markersize=8)[0] for _ in range(num_points)]
+        import matplotlib.animation as animation
+
+        # All particles are drawn by a single artist (see `anim.py`).
+        positions = self._state.positions_view()
+        style = scatter_style(self._state)
+        points = self._ax.scatter(positions[:, 0], positions[:, 1], positions[:, 2], 
+                                  depthshade=False, **style)
 
         # Function to update the animation
         def update(frame):
             self._state.step(self._dt / self._steps_per_update, frame, 
                               steps=self._steps_per_update)
-            for i, data in enumerate(self._state.positions()):
-                points[i].set_data_3d(np.expand_dims(data, axis=1))
-            return points
+            positions = self._state.positions_view()
+            points.set_offsets(positions[:, :2])
+            points.set_sizes(np.atleast_1d(style["s"]))
+            points.set_3d_properties(positions[:, 2], "z")
+            return points,
 
         self._animation = animation.FuncAnimation(
                 self._fig, 
@@ -81,10 +84,10 @@ class Simulation:
     def pause_animation(self):
         self._animation.event_source.pause()
 
-    def save_state(self):
-        state_writer = open("data/current_state.json", "w")
-        state_writer.write(self._state.to_json())
+    def save_state(self, path="data/current_state.ckpt"):
+        # Resume with `SimState.restore(path)`.
+        self._state.checkpoint(path)
 
     def run_animation(self):
         # To be expanded on.
-        plt.show()
+        pyplot().show()
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+#
+#
+# Performance benchmarks. Builds scaled-up versions of the example scenes
+# (`tests/scripts/bounce.txt` and `tests/scripts/solar_system_lite.txt`), and
+# measures, for each scene size and `SimState` backend:
+#
+#   * parse time (`AstBuilder.build_entire_ast`)
+#   * compile time (`sim_state.build_simulation`)
+#   * steps per second
+#   * peak memory (traced allocations while parsing, compiling and stepping)
+#
+# It also measures, in a fresh interpreter, the time to import `sim_state` 
+# and to load and step a pickled simulation, and checks that doing so doesn't 
+# import any of `LAZY_MODULES` (the parser, lark and matplotlib load on first 
+# use).
+#
+# Results are written as JSON, and can be compared with a stored baseline:
+#
+#           python3 -m syzygy bench --out baseline.json
+#           python3 -m syzygy bench --compare baseline.json
+#
+# Pair forces cost O(N^2) per step, so large scenes are stepped for at most
+# `max_seconds`, rather than for a fixed number of steps.
+
+import datetime
+import json
+import math
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from syzygy.sim import sim_state
+
+
+BOUNCE_RULES = """
+force(name=gravity, input=[A], output=A.net_force[2], func="-9.81 * A.mass");
+force(name=air_res, input=[A], output=A.net_force[2], func="-0.5 * A.vel[2]^3");
+force(name=spring, input=[A], output=A.net_force[2], func="1000 * step(-1 * A.pos[2]) ");
+update(input=[A], output=A.pos[2], func="A.pos[2] + dt * A.vel[2]");
+update(input=[A], output=A.vel[2], func="A.vel[2] + dt * A.acc[2]");
+update(input=[A], output=A.acc[2], func="A.net_force[2] / A.mass");
+"""
+
+SOLAR_RULES = """
+force(input=[A,B], func="([6.674e-11] * A.mass * B.mass * (B.pos - A.pos)) / (norm(A.pos - B.pos)^3)");
+update(input=[A], output=A.pos, func="A.pos + dt * A.vel");
+update(input=[A], output=A.vel, func="A.vel + dt * A.acc");
+update(input=[A], output=A.acc, func="A.net_force / A.mass");
+"""
+
+
+def bounce_scene(num_particles):
+    """`num_particles` independent bouncing balls on a grid."""
+    side = math.ceil(math.sqrt(num_particles))
+    points = []
+    for i in range(num_particles):
+        x, y = i % side, i // side
+        height = 1 + (i % 7) / 7
+        points.append(f"point(name=ball{i}, pos=[{x}, {y}, {height}], "
+                      f"vel=[0, 0, 0], acc=[0, 0, 0], mass=1.0);")
+    return "\n".join(points) + BOUNCE_RULES
+
+
+def solar_scene(num_particles):
+    """A sun and `num_particles - 1` bodies on circular orbits."""
+    points = ["point(name=sun, pos=[0, 0, 0], vel=[0, 0, 0], acc=[0, 0, 0], "
+              "mass=1.989e30);"]
+    for i in range(1, num_particles):
+        radius = 5.8e10 * (1 + i / 8)
+        angle = 2.399963 * i # Golden angle
+        speed = math.sqrt(6.674e-11 * 1.989e30 / radius)
+        points.append(
+                f"point(name=body{i}, "
+                f"pos=[{radius * math.cos(angle):.6e}, {radius * math.sin(angle):.6e}, 0], "
+                f"vel=[{-speed * math.sin(angle):.6e}, {speed * math.cos(angle):.6e}, 0], "
+                f"acc=[0, 0, 0], mass=3.3e23);")
+    return "\n".join(points) + SOLAR_RULES
+
+
+SCENES = {
+    "bounce": (bounce_scene, 0.001),
+    "solar": (solar_scene, 3600.0),
+}
+
+
+def measure(scene, num_particles, backend, steps=100, max_seconds=5.0,
+            trace_memory=True, **options):
+    """
+    Benchmark one scene size on one backend.
+
+    Returns
+        dict: The measurements.
+    """
+    from syzygy.parse import parse
+
+    make_script, dt = SCENES[scene]
+    script = make_script(num_particles)
+
+    start = time.perf_counter()
+    tree = parse.AstBuilder().build_entire_ast(script)
+    parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    state = sim_state.build_simulation(tree, script, backend, **options)
+    compile_time = time.perf_counter() - start
+
+    # Step in chunks until `steps` steps or `max_seconds` have passed.
+    steps_done = 0
+    elapsed = 0.0
+    chunk = 1
+    while steps_done < steps and elapsed < max_seconds:
+        chunk = min(chunk, steps - steps_done)
+        start = time.perf_counter()
+        state.step(dt, steps=chunk)
+        elapsed += time.perf_counter() - start
+        steps_done += chunk
+        chunk *= 2
+
+    result = {
+        "scene": scene,
+        "num_particles": num_particles,
+        "backend": backend,
+        "options": options,
+        "parse_time": parse_time,
+        "compile_time": compile_time,
+        "steps": steps_done,
+        "steps_per_second": steps_done / elapsed if elapsed > 0 else float("inf"),
+    }
+
+    # Tracing slows everything down, so memory is measured in a second pass.
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            tree = parse.AstBuilder().build_entire_ast(script)
+            state = sim_state.build_simulation(tree, script, backend, **options)
+            state.step(dt, steps=1)
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+# Modules that importing `sim_state` and stepping a pickled simulation must 
+# not import.
+LAZY_MODULES = ("lark", "matplotlib", "syzygy.parse", "syzygy.compile")
+
+IMPORT_PROBE = """
+import sys
+import time
+
+start = time.perf_counter()
+import json
+import pickle
+from syzygy.sim import sim_state
+import_time = time.perf_counter() - start
+
+start = time.perf_counter()
+state = pickle.loads(sys.stdin.buffer.read())
+state.step(1e-3)
+load_time = time.perf_counter() - start
+
+print(json.dumps({"import_time": import_time, "load_time": load_time, 
+                  "modules": sorted(sys.modules)}))
+"""
+
+
+def measure_imports(repeat=5):
+    """
+    Import `sim_state`, then load and step a pickled simulation, in fresh 
+    interpreters.
+
+    Returns
+        dict: The best import and load times of `repeat` runs, and the 
+        `LAZY_MODULES` that were imported anyway.
+    """
+    state = sim_state.create_simulation(bounce_scene(1))
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [package_root, env.get("PYTHONPATH")]))
+
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_PROBE], 
+                                input=pickle.dumps(state), 
+                                stdout=subprocess.PIPE, env=env, check=True).stdout
+        runs.append(json.loads(output))
+
+    modules = set(runs[0]["modules"])
+    return {
+        "import_time": min(run["import_time"] for run in runs),
+        "load_time": min(run["load_time"] for run in runs),
+        "eager_imports": [name for name in LAZY_MODULES if name in modules],
+    }
+
+
+def run_benchmarks(scenes=None, sizes=(10, 100), backends=None, steps=100,
+                   max_seconds=5.0, trace_memory=True, imports=True, 
+                   on_result=None, **options):
+    """
+    Benchmark every combination of scene, size and backend. `options` are 
+    passed to every simulation (e.g. `dtype`).
+
+    Returns
+        dict: `{"meta": ..., "results": [...], "imports": ...}` (see 
+        `measure` and `measure_imports`).
+    """
+    scenes = scenes or sorted(SCENES)
+    backends = backends or sorted(sim_state.SIM_STATE_CLASSES)
+    results = []
+    for scene in scenes:
+        for num_particles in sizes:
+            for backend in backends:
+                result = measure(scene, num_particles, backend, steps=steps,
+                                 max_seconds=max_seconds,
+                                 trace_memory=trace_memory, **options)
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+
+    meta = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+    }
+    benchmarks = {"meta": meta, "results": results}
+    if imports:
+        benchmarks["imports"] = measure_imports()
+    return benchmarks
+
+
+# Metric name -> True if larger is better.
+METRICS = {
+    "parse_time": False,
+    "compile_time": False,
+    "steps_per_second": True,
+    "peak_memory": False,
+}
+
+IMPORT_METRICS = ("import_time", "load_time")
+
+
+def result_key(result):
+    return (result["scene"], result["num_particles"], result["backend"],
+            json.dumps(result.get("options", {}), sort_keys=True))
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Find regressions of `current` relative to `baseline` (both as returned by
+    `run_benchmarks`).
+
+    Args
+        threshold: Relative change that counts as a regression (0.2 = 20%
+        slower, or 20% more memory).
+
+    Returns
+        list[dict]: One entry per regressed metric.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+        for metric, larger_is_better in METRICS.items():
+            if metric not in result or metric not in base or base[metric] <= 0:
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            if (-change if larger_is_better else change) > threshold:
+                regressions.append({
+                    "scene": result["scene"],
+                    "num_particles": result["num_particles"],
+                    "backend": result["backend"],
+                    "metric": metric,
+                    "baseline": base[metric],
+                    "current": result[metric],
+                    "change": change,
+                })
+
+    base = baseline.get("imports")
+    result = current.get("imports")
+    if base is not None and result is not None:
+        for metric in IMPORT_METRICS:
+            if base[metric] <= 0:
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            if change > threshold:
+                regressions.append({
+                    "scene": "imports",
+                    "num_particles": 0,
+                    "backend": "-",
+                    "metric": metric,
+                    "baseline": base[metric],
+                    "current": result[metric],
+                    "change": change,
+                })
+    return regressions
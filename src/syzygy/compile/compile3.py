@@ -6,6 +6,8 @@
 # The Syzygy `step` Compiler
 #
 
+import copy
+import hashlib
 import lark
 import random
 import string
@@ -24,7 +26,16 @@ def get_default_compiler_options():
         "variables": [],
         "variable_types": [],
         "output_lang": "py",
-        "var_name_mapper": None
+        "var_name_mapper": None,
+        # Emit numpy-friendly code (no python conditionals), so that `data` 
+        # lookups may be arrays.
+        "vectorize": False,
+        # Maps literal text (as written in the script) to a row of `params`. 
+        # Matching literals compile to `params[<row>]` instead of constants.
+        "literal_params": {},
+        # Reductions (`sum` and `mean`) found while compiling are appended 
+        # here, as (global name, kind, source) triples.
+        "reductions": [],
     }
 
 
@@ -78,9 +89,31 @@ class SyzygyFunctionCompiler(lark.Visitor):
         tree.expr = acc 
 
 
+    # Each coordinate of a `let` binding is one temporary, `_<name>_<index>`.
+    def local(self, tree):
+        name, index = tree.children
+        tree.expr = format_temporary(name, index)
+
+
+    def binding(self, tree):
+        name, index, value = tree.children
+        tree.expr = value.expr
+
+
+    def let_expr(self, tree):
+        *bindings, body = tree.children
+        tree.expr = body.expr
+        tree.temporaries = [(format_temporary(*binding.children[:2]), binding.expr) 
+                            for binding in bindings]
+
+
     def literal(self, tree):
         child = tree.children[0]
-        tree.expr = child
+        literal_params = self.compiler_options["literal_params"]
+        if str(child) in literal_params:
+            tree.expr = f"params[{literal_params[str(child)]}]"
+        else:
+            tree.expr = child
 
 
     def add(self, tree):
@@ -113,19 +146,66 @@ class SyzygyFunctionCompiler(lark.Visitor):
         tree.expr = f"abs({child.expr})"
 
 
-    # TODO: Needs testing
+    # `step` and `sign` are arithmetic on a comparison (no conditional), so 
+    # they work on scalars and arrays alike.
     def step(self, tree):
         child = tree.children[0]
-        tree.expr = f"0 if ({child.expr}) < 0 else 1"
+        tree.expr = f"(1 * (({child.expr}) >= 0))"
 
 
-    # TODO: Needs testing
     def sign(self, tree):
         child = tree.children[0]
-        tree.expr = f"-1 if ({child.expr}) < 0 else 1"
+        tree.expr = f"(2 * (({child.expr}) >= 0) - 1)"
+
+
+    def comparison(self, tree):
+        left, comparator, right = tree.children
+        tree.expr = format_binary_operation(left.expr, right.expr, str(comparator))
+
+
+    def where(self, tree):
+        condition, if_true, if_false = tree.children
+        if self.compiler_options["output_lang"] == "c":
+            tree.expr = f"(({condition.expr}) ? ({if_true.expr}) : ({if_false.expr}))"
+        elif self.compiler_options["vectorize"]:
+            tree.expr = f"numpy.where({condition.expr}, {if_true.expr}, {if_false.expr})"
+        else:
+            tree.expr = f"(({if_true.expr}) if ({condition.expr}) else ({if_false.expr}))"
+
+
+    # A reduction compiles to a global holding its value for the current 
+    # step. Its body is compiled again, vectorized, to a function of (particle, 
+    # dt, data) that is called once per step with the indices of every 
+    # particle (see `FuncHandler.compute_reductions`).
+    def _reduction(self, kind, tree):
+        body = tree.children[0]
+        particle_names = sorted({str(subtree.children[0]) for subtree in body.iter_subtrees() 
+                                 if subtree.data == "particle_property_access"})
+        variable = particle_names[0] if particle_names else "_"
+
+        body_options = dict(self.compiler_options)
+        body_options["vectorize"] = True
+        SyzygyFunctionCompiler(body_options).visit(body)
+        source = f"lambda {variable}, dt, data: {body.expr}"
+
+        name = f"{kind}_{hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]}"
+        self.compiler_options["reductions"].append((name, kind, source))
+        tree.expr = name
+
+
+    def sum(self, tree):
+        self._reduction("sum", tree)
+
+
+    def mean(self, tree):
+        self._reduction("mean", tree)
 
 
 # Formatting utilities.
+def format_temporary(name, index):
+    return f"_{name}_{index}"
+
+
 def format_arg_list(variables, lang):
     if lang == "py":
         return ", ".join(variables)
@@ -135,7 +215,12 @@ def format_arg_list(variables, lang):
         return NotImplemented
 
 
-def format_function_definition(expr, options):
+def format_function_definition(expr, options, temporaries=()):
+    """
+    Args
+        temporaries: (name, expr) pairs, assigned in order before `expr` is 
+        evaluated.
+    """
     lang = options["output_lang"]
     if "func_name" in options:
         func_name = options["func_name"]
@@ -143,12 +228,18 @@ def format_function_definition(expr, options):
         func_name = get_default_func_name()
     arg_list = format_arg_list(options["variables"], lang) 
     if lang == "py":
+        if temporaries:
+            # Assignment expressions, then `expr`, as the last item of a tuple.
+            assignments = "".join(f"({name} := {value}), " for name, value in temporaries)
+            expr = f"({assignments}{expr})[-1]"
         func_code = "lambda " + arg_list + ": " + expr
     elif lang == "c":
         # Return type = float for now. Return types should be determined
         # by the user, possibly implicitly.
+        declarations = [f"float {name} = {value};" for name, value in temporaries]
         func_code = " ".join([
             "float", func_name, f"({arg_list})", "{", 
+            *declarations,
             "return", expr, ";", 
             "}"])
     else:
@@ -156,6 +247,21 @@ def format_function_definition(expr, options):
     return func_name, func_code
 
 
+def validate_compiler_options(compiler_options):
+    """`compiler_options` with defaults for the options it doesn't set."""
+    # Validate keyword args --------------------------------------------
+    # Validate `options`
+    options = get_default_compiler_options()
+    if compiler_options is not None:
+        for k, v in compiler_options.items():
+            options[k] = v
+
+    # Check for required options
+    if "particle_metadata" not in options:
+        raise Exception("`compiler_options` must contain an entry for \"particle_metadata\"")
+    return options
+
+
 # Compilation entry point.
 # TODO: REPLACE WITH LARK VISITOR
 def compile_tree(
@@ -174,21 +280,114 @@ def compile_tree(
     Returns:
         tuple[str, str]: The function name, and the function code.
     """
-    # Validate keyword args --------------------------------------------
-    # Validate `options`
-    options = get_default_compiler_options()
-    if compiler_options is not None:
-        for k, v in compiler_options.items():
-            options[k] = v
-
-    # Check for required options
-    if "particle_metadata" not in options:
-        raise Exception("`compiler_options` must contain an entry for \"particle_metadata\"")
+    options = validate_compiler_options(compiler_options)
 
     func_compiler = SyzygyFunctionCompiler(options)
     func_compiler.visit(syntax_tree)
 
     # Create function signature ----------------------------------------
-    func_name, func_code = format_function_definition(syntax_tree.expr, options)
+    func_name, func_code = format_function_definition(
+            syntax_tree.expr, options, getattr(syntax_tree, "temporaries", ()))
 
     return func_name, func_code
+
+
+# Operations whose values may be computed once and shared by the coordinates 
+# of a vector kernel.
+SHAREABLE_RULES = ("add", "sub", "mul", "div", "pow", "abs", "step", "sign", 
+                   "comparison", "where")
+
+
+def iter_subtrees_post_order(tree):
+    """
+    Subtrees of `tree`, children (left to right) before their parents. The 
+    bodies of reductions are skipped (they are compiled separately).
+    """
+    if tree.data not in ("sum", "mean"):
+        for child in tree.children:
+            if isinstance(child, lark.Tree):
+                yield from iter_subtrees_post_order(child)
+    yield tree
+
+
+def compile_vector_tree(syntax_trees, compiler_options=None):
+    """
+    Compile the coordinates of a vector function to one python lambda that 
+    returns a tuple of every coordinate. Subexpressions that occur more than 
+    once (e.g. the distance in each coordinate of a pair force) and `let` 
+    bindings are computed once, into temporaries.
+
+    Args:
+        syntax_trees (list[lark.Tree]): The shaped tree of each coordinate.
+
+    Returns:
+        tuple[str, str]: The function name, and the function code.
+    """
+    options = validate_compiler_options(compiler_options)
+    if options["output_lang"] != "py":
+        raise Exception("Vector kernels can only be compiled to python")
+
+    # Compile each coordinate on its own, and count the subexpressions.
+    func_compiler = SyzygyFunctionCompiler(dict(options, reductions=[]))
+    counts = {}
+    counted = set()
+    for syntax_tree in syntax_trees:
+        for subtree in iter_subtrees_post_order(syntax_tree):
+            func_compiler._call_userfunc(subtree)
+            subtree.key = subtree.expr
+            # Subtrees may be shared (e.g. `let` bindings).
+            if subtree.data in SHAREABLE_RULES and id(subtree) not in counted:
+                counts[subtree.key] = counts.get(subtree.key, 0) + 1
+                counted.add(id(subtree))
+
+    # Compile again, replacing repeated subexpressions by temporaries.
+    func_compiler = SyzygyFunctionCompiler(options)
+    temporaries = []
+    shared = {}
+    for syntax_tree in syntax_trees:
+        for subtree in iter_subtrees_post_order(syntax_tree):
+            func_compiler._call_userfunc(subtree)
+            if subtree.data == "binding":
+                name = format_temporary(*subtree.children[:2])
+                if name not in shared:
+                    temporaries.append((name, subtree.expr))
+                    shared[name] = name
+            elif subtree.data in SHAREABLE_RULES and counts[subtree.key] > 1:
+                if subtree.key not in shared:
+                    shared[subtree.key] = f"_t{len(shared)}"
+                    temporaries.append((shared[subtree.key], subtree.expr))
+                subtree.expr = shared[subtree.key]
+
+    expr = "(" + "".join(f"{syntax_tree.expr}, " for syntax_tree in syntax_trees) + ")"
+    return format_function_definition(expr, options, temporaries)
+
+
+def rename(syntax_tree, particle_names, suffix):
+    """
+    A copy of a shaped tree, with the particles renamed by `particle_names` 
+    (a dict; the bodies of reductions are left alone), and `suffix` appended 
+    to the names bound by `let`.
+    """
+    syntax_tree = copy.deepcopy(syntax_tree)
+    renamed = set()
+    for subtree in iter_subtrees_post_order(syntax_tree):
+        # Subtrees may be shared (e.g. the operands of `norm`).
+        if id(subtree) in renamed:
+            continue
+        renamed.add(id(subtree))
+        name = subtree.children[0] if subtree.children else None
+        if subtree.data == "particle_property_access":
+            subtree.children[0] = name.update(value=particle_names.get(str(name), str(name)))
+        elif subtree.data in ("local", "binding"):
+            subtree.children[0] = name.update(value=str(name) + suffix)
+    return syntax_tree
+
+
+def sum_trees(syntax_trees):
+    """A tree adding up `syntax_trees` (0 if there are none)."""
+    if not syntax_trees:
+        return lark.Tree(lark.Token("RULE", "literal"), [lark.Token("SIGNED_NUMBER", "0")])
+    total = syntax_trees[0]
+    for syntax_tree in syntax_trees[1:]:
+        total = lark.Tree(lark.Token("RULE", "add"), [total, syntax_tree])
+    return total
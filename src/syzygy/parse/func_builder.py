@@ -24,6 +24,10 @@ class LinearAlgebraChecker2(lark.Transformer):
     def __init__(self, metadata, visit_tokens: bool = True) -> None:
         super().__init__(visit_tokens=True)
         self.particle_metadata = metadata
+        # Names bound by `let` so far -> their `vector_expr`s
+        self.bindings = {}
+        # `binding` trees of every coordinate of every binding, in order
+        self.binding_coords = []
 
 
     def _unpack_children(self, tree, num_children, vector_expr=True):
@@ -116,6 +120,59 @@ class LinearAlgebraChecker2(lark.Transformer):
             raise Exception("Expected one `vector_expr` child.")
 
 
+    def binding(self, tree):
+        # Bindings are transformed in order, before the expressions that use 
+        # them, so `local` can look up their dimension.
+        name, value = tree.children
+        name = str(name)
+        if name in self.bindings or name in keyword_dimensions:
+            raise Exception(f"\"{name}\" is already defined")
+        if value.data != "vector_expr":
+            raise Exception("Expected vector_expr operands")
+        self.bindings[name] = value
+        for index, coord in enumerate(value.children):
+            self.binding_coords.append(self._tree("binding", [
+                lark.Token("VARIABLE_NAME", name), lark.Token("NUMBER", index), coord]))
+        return tree
+
+
+    def local(self, tree):
+        name = str(tree.children[0])
+        if name not in self.bindings:
+            raise Exception(f"Unknown name \"{name}\"")
+        dim = len(self.bindings[name].children)
+        return self._vector_expr([self._tree("local", [tree.children[0], lark.Token("NUMBER", i)]) 
+                                  for i in range(dim)])
+
+
+    def let_expr(self, tree):
+        """
+        `let` bindings in `expr` -> Vector of `let_expr`s, one per coordinate 
+        of `expr`, each with the (scalar) bindings that coordinate uses.
+        """
+        body = tree.children[-1]
+        coords = []
+        for coord in body.children:
+            coords.append(self._tree("let_expr", self._used_bindings(coord) + [coord]))
+        return self._vector_expr(coords)
+
+
+    def _used_bindings(self, tree):
+        """The coordinates of bindings `tree` depends on, in order."""
+        def locals_in(tree):
+            return {(str(subtree.children[0]), int(subtree.children[1])) 
+                    for subtree in tree.iter_subtrees() if subtree.data == "local"}
+
+        used = locals_in(tree)
+        bindings = []
+        for binding in reversed(self.binding_coords):
+            name, index, value = binding.children
+            if (str(name), int(index)) in used:
+                used |= locals_in(value)
+                bindings.append(binding)
+        return bindings[::-1]
+
+
     def vector_expr(self, tree):
         # Inline any children that are `vector_expr`s
         for i, child in enumerate(tree.children):
@@ -258,6 +315,71 @@ class LinearAlgebraChecker2(lark.Transformer):
         child = child.children[0] # We're taking the absolute value of this
         return self._unary_builtin("sign", child)
 
+
+    def _broadcast(self, operands):
+        """
+        Repeat the scalar operands (`vector_expr`s with one coordinate) to 
+        the dimension of the others.
+        """
+        dim = max(len(operand.children) for operand in operands)
+        for operand in operands:
+            if len(operand.children) == dim:
+                continue
+            if len(operand.children) != 1:
+                raise Exception("Dimension mismatch and niether operand is a scalar")
+            operand.children = [copy.deepcopy(operand.children[0]) 
+                                for _ in range(dim)]
+        return dim
+
+
+    def comparison(self, tree):
+        # Expects `vector_expr`, COMPARATOR, `vector_expr`. Vectors are 
+        # compared coordinate by coordinate.
+        left, comparator, right = tree.children
+        if left.data != "vector_expr" or right.data != "vector_expr":
+            raise Exception("Expected vector_expr operands")
+        self._broadcast([left, right])
+        return self._vector_expr([self._tree("comparison", [ll, comparator, rr]) 
+                                  for ll, rr in zip(left.children, right.children)])
+
+
+    def where(self, tree):
+        # where(condition, a, b), coordinate by coordinate.
+        condition, if_true, if_false = self._unpack_children(tree, 3)
+        self._broadcast([condition, if_true, if_false])
+        return self._vector_expr([self._tree("where", list(coords)) 
+                                  for coords in zip(condition.children, 
+                                                    if_true.children, 
+                                                    if_false.children)])
+
+
+    def _reduction(self, rule, tree):
+        """
+        A reduction (`sum` or `mean`) of a vector over all particles -> 
+        Vector of reductions of its coordinates. The body may read the 
+        properties of one particle, which ranges over all particles.
+        """
+        child = self._unpack_children(tree, 1)
+        particle_names = set()
+        for subtree in child.iter_subtrees():
+            if subtree.data in ("sum", "mean"):
+                raise Exception("Reductions can't be nested")
+            if subtree.data == "local":
+                raise Exception("Reductions can't use names bound by `let`")
+            if subtree.data == "particle_property_access":
+                particle_names.add(str(subtree.children[0]))
+        if len(particle_names) > 1:
+            raise Exception("A reduction may only read the properties of one particle")
+        return self._vector_expr([self._tree(rule, [coord]) for coord in child.children])
+
+
+    def sum(self, tree):
+        return self._reduction("sum", tree)
+
+
+    def mean(self, tree):
+        return self._reduction("mean", tree)
+
         
 
 # TODO: Chain operands, reduce powers, etc.
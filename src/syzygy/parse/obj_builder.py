@@ -10,14 +10,35 @@
 #   * forces
 #   * update rules
 #
+# A bond is a force that only acts between the listed pairs of particles. 
+# Bonds are forces with a "pairs" entry: a list of [name, name] pairs, given 
+# in the script or read from a file with one pair per line (names separated 
+# by whitespace or a comma; blank lines and lines starting with "#" or "//" 
+# are skipped).
+#
+# Files are only read when the builder is given a `script_dir` (the 
+# directory of the script, which relative paths are resolved against), so 
+# scripts from untrusted sources can't read files. `files` records the 
+# SHA-256 of every file read.
+#
+# A collision is a force that only acts between particles that touch (closer 
+# than the sum of their `radius` properties). Collisions are forces with a 
+# "contact" entry.
+#
 
 
+import hashlib
+import os
+
 import lark
 
 
 class ParticleMetadataBuilder(lark.Visitor):
-    def __init__(self) -> None:
+    def __init__(self, script_dir=None) -> None:
         super().__init__()
+        self.script_dir = script_dir
+        # Path -> SHA-256 of the contents, for every file read
+        self.files = {}
         self.prop_sizes = {}
         self.num_particles = 0
 
@@ -68,6 +89,51 @@ class ParticleMetadataBuilder(lark.Visitor):
         self.forces[name] = {}
 
 
+    def bond(self, tree):
+        name_assign, pairs_assign, input_assign, output_assign, function_assign = tree.children
+
+        if len(input_assign.children) != 2:
+            raise Exception("A bond needs two inputs")
+
+        # A bond is a force with a list of pairs.
+        force = lark.Tree(lark.Token('RULE', 'force'), 
+                          [name_assign, input_assign, output_assign, function_assign])
+        self.force(force)
+        tree.children[0] = force.children[0]
+        tree.children[3] = force.children[2]
+        pairs_assign.assignee = force.children[0].children[0].value
+        pairs_assign.function_type = "force"
+
+
+    def collision(self, tree):
+        if len(tree.children[1].children) != 2:
+            raise Exception("A collision needs two inputs")
+
+        # A collision is a force that only acts on particles in contact.
+        self.force(tree)
+        self.forces[tree.children[0].children[0].value]["contact"] = True
+
+
+    def pairs_assign(self, tree):
+        if len(tree.children) == 1 and isinstance(tree.children[0], lark.Token):
+            pairs = self.read_pairs(tree.children[0].value.strip("\""))
+        else:
+            pairs = [[name.value for name in pair.children] 
+                     for pair in tree.children if pair is not None]
+        self.data[tree.function_type][tree.assignee]["pairs"] = pairs
+
+
+    def read_pairs(self, name):
+        """Read the file of particle pairs `name` (see the top of this module)."""
+        if self.script_dir is None:
+            raise Exception(f"Can't read \"{name}\": this script may not read files")
+        path = os.path.join(self.script_dir, name)
+        with open(path, "rb") as reader:
+            contents = reader.read()
+        self.files[path] = hashlib.sha256(contents).hexdigest()
+        return parse_pairs(contents.decode("utf-8"), path)
+
+
     def update(self, tree):
         name_assign, input_assign, output_assign, function_assign = tree.children
 
@@ -152,3 +218,19 @@ class ParticleMetadataBuilder(lark.Visitor):
         self.data[tree.function_type][tree.assignee]["output"]["property_name"] = property_name.value
         if property_index is not None:
             self.data[tree.function_type][tree.assignee]["output"]["property_index"] = property_index.value
+
+
+def parse_pairs(text, path):
+    """Parse the contents of a file of particle pairs, read from `path`."""
+    pairs = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("//"):
+            continue
+        names = line.replace(",", " ").split()
+        if len(names) != 2:
+            # The line itself isn't echoed; the file may not be the user's.
+            raise Exception(f"\"{path}\", line {number}: expected a pair of "
+                            f"particle names")
+        pairs.append(names)
+    return pairs
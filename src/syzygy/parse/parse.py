@@ -5,11 +5,20 @@
 #
 # This module is responsible for parsing an entire script; objects, functions 
 # and all.
+#
+# An incremental `AstBuilder` parses a script one statement at a time, and 
+# remembers each statement and function by a fingerprint of its text. 
+# Building a new version of a script then only parses and shapes the 
+# statements that changed. Only the statements and functions of the last 
+# script built are kept, so the caches don't grow as a script is edited.
 
 import copy
+import hashlib
+import json
 import lark
 
 from syzygy.sim import data_layout
+from syzygy.sim import profiling
 from syzygy.parse.obj_builder import *
 from syzygy.parse.func_builder import * 
 
@@ -42,32 +51,113 @@ class ParticlePropertyAccessBuilder(lark.Visitor):
 
 
 
+def split_statements(script):
+    """
+    Split a script after each top-level `;` (outside of strings and 
+    comments). The last piece holds whatever follows the last `;`.
+    """
+    statements = []
+    start = 0
+    i = 0
+    in_string = False
+    while i < len(script):
+        char = script[i]
+        if in_string:
+            if char == "\\":
+                i += 1
+            elif char == "\"":
+                in_string = False
+        elif char == "\"":
+            in_string = True
+        elif script.startswith("//", i):
+            newline = script.find("\n", i)
+            i = len(script) if newline == -1 else newline
+            continue
+        elif char == ";":
+            statements.append(script[start:i + 1])
+            start = i + 1
+        i += 1
+    statements.append(script[start:])
+    return statements
+
+
+def fingerprint(*parts):
+    """A short hash of JSON-serializable `parts`."""
+    key = json.dumps(parts, sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
 class AstBuilder:
-    def __init__(self):
+    def __init__(self, incremental=False):
+        """
+        Args
+            incremental: If True, keep the parse tree of every statement and 
+            the shaped tree of every function of the last script built, and 
+            reuse them when the next script repeats them.
+        """
         # FIXME: Embed this in a context class or an environment variable
         GRAMMAR_PATH = "../grammar/grammar.lark"
         # Generate parsers
-        self.obj_parser = lark.Lark.open(GRAMMAR_PATH, rel_to=__file__, start="particle_group") 
-        self.parser = lark.Lark.open(GRAMMAR_PATH, rel_to=__file__, strict=False, start="start")
+        with profiling.startup_phase("grammar"):
+            self.obj_parser = lark.Lark.open(GRAMMAR_PATH, rel_to=__file__, start="particle_group") 
+            self.parser = lark.Lark.open(GRAMMAR_PATH, rel_to=__file__, strict=False, start="start")
+        self.incremental = incremental
+        # Statement text -> parse tree
+        self._statement_cache = {}
+        # Function fingerprint -> coordinate function entries
+        self._function_cache = {}
+        # The entries of `_function_cache` used by the build in progress
+        self._used_functions = {}
 
 
-    # PARSING HAPPENS HERE
     def maybe_split_function_into_coordinates(self, entry, metadata):
+        if not self.incremental:
+            return self._split_function_into_coordinates(entry, metadata)
+
+        # Shaping depends on the sizes of the properties.
+        key = fingerprint(entry["name"], entry["inputs"], entry["output"], 
+                          entry["func"], list(metadata.prop_names), 
+                          list(metadata.prop_sizes))
+        if key not in self._function_cache:
+            coords = self._split_function_into_coordinates(entry, metadata)
+            for index, coord in enumerate(coords):
+                coord["fingerprint"] = f"{key}:{index}"
+            self._function_cache[key] = coords
+        else:
+            report = profiling.startup_report()
+            if report is not None:
+                report.count("reused_functions")
+        self._used_functions[key] = self._function_cache[key]
+        # Callers may modify the entries, but not the shaped trees.
+        return [dict(coord) for coord in self._function_cache[key]]
+
+
+    # PARSING HAPPENS HERE
+    def _split_function_into_coordinates(self, entry, metadata):
         coordinate_function_entries = []
         output = entry["output"]
         func = entry["func"]
         
         # Parse
-        tree = self.parser.parse(func)
+        with profiling.startup_phase("parse_functions"):
+            tree = self.parser.parse(func)
         
         # Shape
-        tree = LinearAlgebraChecker2(metadata).transform(tree)
+        report = profiling.startup_report()
+        if report is not None:
+            report.count("functions")
+            report.count("nodes_before_shaping", profiling.count_nodes(tree))
+        with profiling.startup_phase("shape"):
+            tree = LinearAlgebraChecker2(metadata).transform(tree)
+        if report is not None:
+            report.count("nodes_after_shaping", profiling.count_nodes(tree))
 
         coords = tree.children
 
         if len(coords) == 1 and output["property_index"] is not None:
             coords[0] = {
                     "name": str(entry["name"]),
+                    "rule": str(entry["name"]),
                     "inputs": entry["inputs"],
                     "output": {
                         "particle_name": output["particle_name"],
@@ -80,6 +170,7 @@ class AstBuilder:
             for index, coord in enumerate(coords):
                 coords[index] = {
                         "name": str(entry["name"]) + str(index),
+                        "rule": str(entry["name"]),
                         "inputs": entry["inputs"],
                         "output": {
                             "particle_name": output["particle_name"],
@@ -94,13 +185,20 @@ class AstBuilder:
 
     def build_out_functions(self, tree: dict):
         metadata = data_layout.ParticleMetadata(tree["particles"])
+        self._used_functions = {}
 
         new_forces = []
         for entry in tree["forces"]:
             # By default, a force's output is `net_force`.
             #self.specify_function_output(entry, "force")
-            new_forces.extend(self.maybe_split_function_into_coordinates(entry, 
-                                                                    metadata))
+            coords = self.maybe_split_function_into_coordinates(entry, metadata)
+            for key in ("pairs", "contact"):
+                # Not part of the cached entries: the pairs may change 
+                # without the function changing.
+                if key in entry:
+                    for coord in coords:
+                        coord[key] = entry[key]
+            new_forces.extend(coords)
         tree["forces"] = new_forces
 
         new_update_rules = []
@@ -111,20 +209,66 @@ class AstBuilder:
                                                                           metadata))
         tree["updates"] = new_update_rules
 
+        # Forget the functions this script doesn't have.
+        if self.incremental:
+            self._function_cache = self._used_functions
+        self._used_functions = {}
+
     
-    def build_entire_ast(self, script):
+    def parse_statements(self, script):
+        """
+        Parse `script` one statement at a time, reusing the parse trees of 
+        statements seen before. Returns the same tree as 
+        `self.obj_parser.parse(script)`.
+        """
+        *statements, rest = split_statements(script)
+        entries = []
+        used = {}
+        try:
+            for statement in statements:
+                if statement in self._statement_cache:
+                    used[statement] = self._statement_cache[statement]
+                    report = profiling.startup_report()
+                    if report is not None:
+                        report.count("reused_statements")
+                elif statement not in used:
+                    used[statement] = self.obj_parser.parse(statement)
+                entries.extend(used[statement].children)
+            # Only whitespace and comments may follow the last statement.
+            self.obj_parser.parse(rest)
+        except lark.exceptions.LarkError:
+            # Report the error with its position in the whole script.
+            self.obj_parser.parse(script)
+            raise
+        # Forget the statements this script doesn't have.
+        self._statement_cache = used
+        return lark.Tree(lark.Token("RULE", "particle_group"), entries)
+
+
+    def build_entire_ast(self, script, script_dir=None):
         """
         The main interface to this class. Converts a script into an AST
         whose branches (`particles`, `forces`, `updates`) may be passed into 
-        the `SimState` constructor.
+        the `SimState` constructor. `files` maps the paths of the files the 
+        script read to their SHA-256.
+
+        Args
+            script_dir: Directory to resolve the files named in the script 
+            against (see `obj_builder.py`). If None, scripts that read files 
+            are rejected.
         """
-        tree = self.obj_parser.parse(script)
+        with profiling.startup_phase("parse_objects"):
+            if self.incremental:
+                tree = self.parse_statements(script)
+            else:
+                tree = self.obj_parser.parse(script)
 
-        tree_cpy = lark.Transformer().transform(tree)
+        with profiling.startup_phase("metadata"):
+            tree_cpy = lark.Transformer().transform(tree)
 
-        # TESTING
-        pmb = ParticleMetadataBuilder()
-        pmb.visit_topdown(tree_cpy)
+            # TESTING
+            pmb = ParticleMetadataBuilder(script_dir)
+            pmb.visit_topdown(tree_cpy)
     
         # --- Switch formats --- 
         # TODO: Link up the two ends and avoid the format-switching.
@@ -137,6 +281,11 @@ class AstBuilder:
                    "output": pmb.forces[name]["output"],
                    "func": pmb.forces[name]["func"]}
                   for name in pmb.forces.keys()]
+        # Bonds and collisions (see `obj_builder.py`)
+        for force in forces:
+            for key in ("pairs", "contact"):
+                if key in pmb.forces[force["name"]]:
+                    force[key] = pmb.forces[force["name"]][key]
 
         updates = [{"name": name, 
                    "inputs": pmb.updates[name]["inputs"],
@@ -149,8 +298,13 @@ class AstBuilder:
                 "group-id":     0, 
                 "forces":       forces, 
                 "particles":    particles, 
-                "updates": updates}
+                "updates": updates,
+                "files":        pmb.files}
 
         self.build_out_functions(unfinished_tree)
 
+        report = profiling.startup_report()
+        if report is not None:
+            report.count("particles", len(particles))
+
         return unfinished_tree
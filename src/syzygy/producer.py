@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+#
+#
+# Runs a `SimState` on a background thread, so that physics and rendering
+# don't stall each other.
+#
+#   * `FrameRing` is a bounded ring buffer of position snapshots. Publishing
+#     never blocks; once the ring is full the oldest frame is overwritten.
+#   * `SimulationProducer` is the worker thread. It advances the state and
+#     publishes a snapshot every `steps_per_frame` steps.
+#
+# Consumers (the animators, the web server) read the latest frame and skip
+# any frames they were too slow to draw.
+
+import queue
+import threading
+import time
+
+import numpy
+
+
+class FrameRing:
+    def __init__(self, capacity, frame_shape, dtype=numpy.float64):
+        if capacity < 1:
+            raise ValueError("`capacity` must be positive")
+        self._frames = numpy.zeros((capacity,) + tuple(frame_shape), dtype=dtype)
+        self._times = numpy.zeros(capacity)
+        self._count = 0
+        self._lock = threading.Lock()
+
+
+    def capacity(self):
+        return self._frames.shape[0]
+
+
+    def count(self):
+        """Number of frames published so far (including overwritten ones)."""
+        return self._count
+
+
+    def publish(self, frame, t):
+        """Copy `frame` into the ring, overwriting the oldest frame if full."""
+        with self._lock:
+            slot = self._count % self.capacity()
+            self._frames[slot] = frame
+            self._times[slot] = t
+            self._count += 1
+
+
+    def latest(self, out):
+        """
+        Copy the most recent frame into `out`.
+
+        Returns
+            tuple[int, float] | None: The frame's sequence number and
+            simulation time, or None if nothing has been published yet.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            seq = self._count - 1
+            slot = seq % self.capacity()
+            out[...] = self._frames[slot]
+            return seq, self._times[slot]
+
+
+
+class SimulationProducer(threading.Thread):
+    def __init__(self, state, dt, steps_per_frame, ring, min_frame_interval=0.0):
+        """
+        Args
+            state: The `SimState` to advance. While the producer is running,
+            no other thread should touch it.
+            dt: Time elapsed between steps.
+            steps_per_frame: Number of steps between published frames.
+            ring: The `FrameRing` frames are published to.
+            min_frame_interval: Minimum wall time (in seconds) between
+            published frames. Keeps a fast simulation from running ahead of
+            the renderer.
+        """
+        super().__init__(daemon=True)
+        self._state = state
+        self._dt = dt
+        self._steps_per_frame = steps_per_frame
+        self._ring = ring
+        self._min_frame_interval = min_frame_interval
+        self._running = threading.Event()
+        self._running.set()
+        self._stopped = threading.Event()
+        # Prepared states to switch to (see `reload`).
+        self._reloads = queue.Queue()
+
+
+    def run(self):
+        positions = self._state.positions_view()
+        self._ring.publish(positions, self._state.time())
+
+        while not self._stopped.is_set():
+            self._running.wait()
+            if self._stopped.is_set():
+                break
+
+            while not self._reloads.empty():
+                self._state.apply_reload(self._reloads.get())
+                positions = self._state.positions_view()
+
+            start = time.perf_counter()
+            self._state.step(self._dt, steps=self._steps_per_frame)
+            self._ring.publish(positions, self._state.time())
+
+            remaining = self._min_frame_interval - (time.perf_counter() - start)
+            if remaining > 0:
+                self._stopped.wait(remaining)
+
+
+    def reload(self, script, builder=None):
+        """
+        Switch the state to an edited script (see `SimState.reload`) before 
+        the next frame. The script is compiled on the calling thread. 
+        Published frames keep their shape, so the number of particles must 
+        stay the same.
+        """
+        new_state = self._state.prepare_reload(script, builder)
+        if new_state.positions_view().shape != self._state.positions_view().shape:
+            raise ValueError("Reloading a running simulation can't change its "
+                             "number of particles")
+        self._reloads.put(new_state)
+
+
+    def pause(self):
+        self._running.clear()
+
+
+    def resume(self):
+        self._running.set()
+
+
+    def stop(self):
+        """Stop the thread after the current frame and wait for it to exit."""
+        self._stopped.set()
+        self._running.set()
+        if self.is_alive():
+            self.join()
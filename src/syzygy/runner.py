@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+#
+#
+# Headless simulation runs. Nothing in this module (or anything it imports)
+# may import matplotlib, so that simulations can run on machines without a
+# display.
+
+import json
+import os
+import time
+
+import numpy
+from numpy.lib import format as npy_format
+
+
+def run(state, dt, steps, record_dir=None, record_every=1):
+    """
+    Steps `state` without rendering it.
+
+    Args
+        state: A `SimState`.
+        dt: Time elapsed between steps.
+        steps: Number of steps.
+        record_dir: If not None, positions are written to
+        `<record_dir>/positions.npy` as a (frames, num_particles, dim) array,
+        along with `times.npy` and `summary.json`.
+        record_every: Record the positions once every `record_every` steps.
+
+    Returns
+        dict: A summary of the run (steps, elapsed time, steps per second).
+    """
+    if record_every < 1:
+        raise ValueError("`record_every` must be positive")
+
+    positions = state.positions_view()
+    num_frames = steps // record_every + 1
+
+    trajectory = None
+    times = None
+    if record_dir is not None:
+        os.makedirs(record_dir, exist_ok=True)
+        # Written through a memory map, so memory use doesn't grow with
+        # the number of steps.
+        trajectory = npy_format.open_memmap(
+                os.path.join(record_dir, "positions.npy"), mode="w+",
+                dtype=positions.dtype, shape=(num_frames,) + positions.shape)
+        times = numpy.zeros(num_frames)
+        trajectory[0] = positions
+        times[0] = state.time()
+
+    elapsed = 0.0
+    steps_done = 0
+    frame = 1
+    while steps_done < steps:
+        chunk = min(record_every, steps - steps_done)
+        start = time.perf_counter()
+        state.step(dt, steps=chunk)
+        elapsed += time.perf_counter() - start
+        steps_done += chunk
+
+        if trajectory is not None and chunk == record_every:
+            trajectory[frame] = positions
+            times[frame] = state.time()
+            frame += 1
+
+    summary = {
+        "steps": steps,
+        "dt": dt,
+        "num_particles": state.data_layout.num_particles(),
+        "elapsed": elapsed,
+        "steps_per_second": steps / elapsed if elapsed > 0 else float("inf"),
+        "time": state.time(),
+    }
+
+    if record_dir is not None:
+        trajectory.flush()
+        numpy.save(os.path.join(record_dir, "times.npy"), times)
+        summary["particle_names"] = list(state.data_layout.particle_metadata.particle_names)
+        summary["record_every"] = record_every
+        with open(os.path.join(record_dir, "summary.json"), "w") as writer:
+            json.dump(summary, writer, indent=2)
+
+    return summary
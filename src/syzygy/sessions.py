@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+#
+#
+# Runs many simulations at once on a pool of worker processes (see `web.py`).
+#
+#   * `SessionManager` compiles submitted scripts, admits or rejects them
+#     against a budget of particle-steps per second, and assigns each
+#     session to the least loaded worker.
+#   * Each worker process steps its sessions at their frame rates, and
+#     writes each new frame into the session's `FrameSlot`.
+#   * A `FrameSlot` is a block of shared memory holding only the latest frame.
+#     Workers never wait for readers, and nothing queues up: a reader that
+#     falls behind just sees a later frame.
+#
+# `SessionManager.poll` hands new frames to each session's subscribers.
+# Subscribers are plain callables, so the manager knows nothing about
+# websockets.
+
+import itertools
+import math
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+import traceback
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import numpy
+
+from syzygy.sim import sim_state
+
+
+class SessionError(Exception):
+    """A session could not be created."""
+
+
+
+class AdmissionError(SessionError):
+    """Running a session would exceed the particle-steps budget."""
+
+
+
+class FrameSlot:
+    """
+    The latest (num_particles, dim) frame of a session, in shared memory.
+    Writes are guarded by a sequence lock: the sequence number is odd while
+    a frame is being written, and advances by 2 per frame.
+    """
+    _HEADER = 2 # words: sequence number, simulation time
+
+    def __init__(self, shape, name=None):
+        self.shape = tuple(shape)
+        size = 8 * (self._HEADER + int(numpy.prod(self.shape)))
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # Only the creating process should unlink the block.
+            if sys.version_info < (3, 13):
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+        self.name = self._shm.name
+        self._seq = numpy.ndarray((1,), dtype=numpy.int64, buffer=self._shm.buf)
+        self._time = numpy.ndarray((1,), dtype=numpy.float64, buffer=self._shm.buf, offset=8)
+        self._frame = numpy.ndarray(self.shape, dtype=numpy.float64,
+                                    buffer=self._shm.buf, offset=8 * self._HEADER)
+        if name is None:
+            self._seq[0] = 0
+
+
+    def write(self, frame, t):
+        self._seq[0] += 1
+        self._frame[...] = frame
+        self._time[0] = t
+        self._seq[0] += 1
+
+
+    def read(self, out):
+        """
+        Copy the latest frame into `out`.
+
+        Returns
+            tuple[int, float] | None: The frame's sequence number and
+            simulation time, or None if no complete frame could be read.
+        """
+        seq = int(self._seq[0])
+        if seq == 0 or seq % 2 == 1:
+            return None
+        out[...] = self._frame
+        t = float(self._time[0])
+        if int(self._seq[0]) != seq:
+            return None # Overwritten while copying
+        return seq // 2, t
+
+
+    def close(self, unlink=False):
+        del self._seq, self._time, self._frame
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+
+class Session:
+    """Bookkeeping for one simulation, on the manager's side."""
+    def __init__(self, session_id, worker, slot, num_particles, cost, fps,
+                 backend="python-lambdas", builder=None):
+        self.id = session_id
+        self.worker = worker
+        self.slot = slot
+        self.num_particles = num_particles
+        # Particle-steps per second.
+        self.cost = cost
+        self.fps = fps
+        self.backend = backend
+        # Compiles the session's reloads (see `SimulationBuilder`).
+        self.builder = builder
+        self.subscribers = set()
+        self.paused = False
+        self.error = None
+        self.idle_since = time.monotonic()
+        self._frame = numpy.zeros(slot.shape)
+        self._last_seq = 0
+
+
+
+class SessionManager:
+    def __init__(self, workers=2, max_particle_steps=1e6, idle_timeout=None):
+        """
+        Args
+            workers: Number of worker processes.
+            max_particle_steps: Admission limit on the total particle-steps
+            per second (particles * steps per frame * frames per second) of
+            all running sessions.
+            idle_timeout: Close sessions that have had no subscribers for
+            this many seconds. None to keep them forever.
+        """
+        self.max_particle_steps = max_particle_steps
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self._ids = itertools.count(1)
+        self._errors = multiprocessing.Queue()
+        self._commands = []
+        self._workers = []
+        self._worker_load = [0.0] * workers
+        for _ in range(workers):
+            commands = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_worker_main,
+                                             args=(commands, self._errors),
+                                             daemon=True)
+            worker.start()
+            self._commands.append(commands)
+            self._workers.append(worker)
+
+
+    def load(self):
+        """Total particle-steps per second of all sessions."""
+        return sum(self._worker_load)
+
+
+    def compile(self, script, backend="python-lambdas", builder=None):
+        """
+        Compile `script`. Doesn't touch the manager, so it may run on another 
+        thread (compiling takes from a fraction of a second to seconds).
+
+        Args
+            builder: The `SimulationBuilder` that compiled earlier versions 
+            of `script`, if any. Defaults to a new one.
+
+        Returns
+            tuple[SimState, SimulationBuilder]: The compiled state, and the 
+            builder to compile edited versions of `script` with.
+
+        Raises
+            SessionError: If the script doesn't compile.
+        """
+        try:
+            if builder is None:
+                builder = sim_state.SimulationBuilder()
+            return sim_state.create_simulation(script, backend, builder=builder), builder
+        except Exception as err:
+            raise SessionError(f"Script failed to compile: {err}") from err
+
+
+    def create(self, script, dt, steps_per_frame=1, fps=30, backend="python-lambdas",
+               state=None, builder=None):
+        """
+        Compile `script` and start running it on a worker.
+
+        Args
+            state, builder: `script`, already compiled by `compile`, and the 
+            builder that compiled it.
+
+        Returns
+            Session: The new session.
+
+        Raises
+            SessionError: If the script doesn't compile, `dt`, 
+            `steps_per_frame` or `fps` isn't a positive number, or running it 
+            would exceed `max_particle_steps`, or its frames aren't 
+            (num_particles, dim) arrays (e.g. "ensemble" states).
+        """
+        for name, value in (("dt", dt), ("steps_per_frame", steps_per_frame), 
+                            ("fps", fps)):
+            if not (math.isfinite(value) and value > 0):
+                raise SessionError(f"`{name}` must be a positive number, got {value}")
+        if state is None:
+            state, builder = self.compile(script, backend)
+        if state.positions_view().ndim != 2:
+            raise SessionError(f"Sessions can't stream \"{backend}\" simulations "
+                               f"(frames must be (num_particles, dim) arrays)")
+
+        num_particles = state.data_layout.num_particles()
+        cost = num_particles * steps_per_frame * fps
+        # The load is a running sum, which one NaN or inf would break for good.
+        if not math.isfinite(cost):
+            raise SessionError(f"Session cost isn't finite ({cost} particle-steps/s)")
+        if self.load() + cost > self.max_particle_steps:
+            raise AdmissionError(f"Over budget: session needs {cost:.3g} particle-steps/s, "
+                                 f"{self.max_particle_steps - self.load():.3g} available")
+
+        worker = min(range(len(self._workers)), key=lambda i: self._worker_load[i])
+        slot = FrameSlot(state.positions_view().shape)
+        session = Session(next(self._ids), worker, slot, num_particles, cost, fps,
+                          backend, builder)
+        self.sessions[session.id] = session
+        self._worker_load[worker] += cost
+
+        # The compiled state is pickled to the worker (see `func_handler.py`).
+        self._commands[worker].put(("start", session.id, state, dt,
+                                    steps_per_frame, fps, slot.name))
+        return session
+
+
+    def close(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        self._worker_load[session.worker] -= session.cost
+        self._commands[session.worker].put(("stop", session_id))
+        session.slot.close(unlink=True)
+
+
+    def reload(self, session_id, script, state=None):
+        """
+        Switch a running session to an edited script, keeping its current 
+        state (see `SimState.reload`). The script is compiled here, with the 
+        session's builder; the worker only swaps it in between two frames.
+
+        Args
+            state: `script`, already compiled by `compile` (with 
+            `session.builder`).
+
+        Raises
+            SessionError: If the script doesn't compile, or changes the 
+            number of particles.
+        """
+        session = self.sessions[session_id]
+        if state is None:
+            state, _ = self.compile(script, session.backend, session.builder)
+        if state.positions_view().shape != session.slot.shape:
+            raise SessionError("Reloading a session can't change its number of particles")
+        self._commands[session.worker].put(("reload", session_id, state))
+
+
+    def pause(self, session_id):
+        session = self.sessions[session_id]
+        session.paused = True
+        self._commands[session.worker].put(("pause", session_id))
+
+
+    def resume(self, session_id):
+        session = self.sessions[session_id]
+        session.paused = False
+        self._commands[session.worker].put(("resume", session_id))
+
+
+    def subscribe(self, session_id, callback):
+        """Call `callback(positions, seq, t)` with each new frame."""
+        self.sessions[session_id].subscribers.add(callback)
+
+
+    def unsubscribe(self, session_id, callback):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        session.subscribers.discard(callback)
+        if not session.subscribers:
+            session.idle_since = time.monotonic()
+
+
+    def poll(self):
+        """
+        Deliver new frames to subscribers, record worker errors and close idle
+        sessions. Call this periodically (e.g. once per frame).
+        """
+        while True:
+            try:
+                session_id, message = self._errors.get_nowait()
+            except queue.Empty:
+                break
+            if session_id in self.sessions:
+                self.sessions[session_id].error = message
+
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if not session.subscribers:
+                if (self.idle_timeout is not None
+                        and now - session.idle_since > self.idle_timeout):
+                    self.close(session.id)
+                continue
+
+            published = session.slot.read(session._frame)
+            if published is None or published[0] == session._last_seq:
+                continue
+            seq, t = published
+            session._last_seq = seq
+            for callback in list(session.subscribers):
+                # One broken subscriber mustn't hold up every other session.
+                try:
+                    callback(session._frame, seq, t)
+                except Exception:
+                    session.error = traceback.format_exc()
+                    self.unsubscribe(session.id, callback)
+
+
+    def shutdown(self):
+        for session_id in list(self.sessions):
+            self.close(session_id)
+        for commands in self._commands:
+            commands.put(("shutdown",))
+        for worker in self._workers:
+            worker.join(timeout=5)
+
+
+
+class _WorkerSession:
+    def __init__(self, state, dt, steps_per_frame, fps, slot):
+        self.state = state
+        self.dt = dt
+        self.steps_per_frame = steps_per_frame
+        self.interval = 1 / fps
+        self.slot = slot
+        self.paused = False
+        self.next_frame = time.monotonic()
+
+
+
+def _worker_main(commands, errors):
+    """Worker process loop. Steps each session whenever its next frame is due."""
+    # The manager's process handles Ctrl+C and shuts the workers down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sessions = {}
+
+    while True:
+        running = [s for s in sessions.values() if not s.paused]
+        timeout = None
+        if running:
+            timeout = max(0, min(s.next_frame for s in running) - time.monotonic())
+
+        try:
+            command = commands.get(timeout=timeout) if timeout != 0 else commands.get_nowait()
+        except queue.Empty:
+            command = None
+
+        if command is not None:
+            kind, args = command[0], command[1:]
+            if kind == "shutdown":
+                break
+            elif kind == "start":
+                session_id, state, dt, steps_per_frame, fps, slot_name = args
+                try:
+                    slot = FrameSlot(state.positions_view().shape, name=slot_name)
+                    slot.write(state.positions_view(), state.time())
+                    sessions[session_id] = _WorkerSession(state, dt, steps_per_frame, fps, slot)
+                except Exception:
+                    errors.put((session_id, traceback.format_exc()))
+            elif kind == "stop":
+                session = sessions.pop(args[0], None)
+                if session is not None:
+                    session.slot.close()
+            elif kind == "reload":
+                session = sessions.get(args[0])
+                if session is not None:
+                    try:
+                        new_state = args[1]
+                        session.state.carry_over_particles(new_state)
+                        if new_state.positions_view().shape != session.slot.shape:
+                            raise SessionError("Reloading a session can't change its "
+                                               "number of particles")
+                        session.state.apply_reload(new_state)
+                    except Exception:
+                        errors.put((args[0], traceback.format_exc()))
+            elif kind in ("pause", "resume"):
+                session = sessions.get(args[0])
+                if session is not None:
+                    session.paused = kind == "pause"
+                    session.next_frame = time.monotonic()
+            continue
+
+        now = time.monotonic()
+        for session_id, session in list(sessions.items()):
+            if session.paused or session.next_frame > now:
+                continue
+            try:
+                session.state.step(session.dt, steps=session.steps_per_frame)
+            except Exception:
+                errors.put((session_id, traceback.format_exc()))
+                session.paused = True
+                continue
+            session.slot.write(session.state.positions_view(), session.state.time())
+            # Don't try to catch up on missed frames.
+            session.next_frame = max(session.next_frame + session.interval, now)
+
+    for session in sessions.values():
+        session.slot.close()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+#
+# Binary checkpoints for `SimState` objects.
+#
+# A checkpoint file is laid out as follows:
+#
+#   * `MAGIC` (8 bytes)
+#   * The length of the header, as a little-endian uint32
+#   * A JSON header (data layout, time counter, script hash, dtype, etc.)
+#   * Zero padding up to a multiple of `ALIGNMENT` bytes
+#   * The raw simulation data array
+#
+# The data section is aligned so that `read_checkpoint` can memory-map it
+# directly, rather than reading and decoding it.
+#
+# `write_checkpoint` writes to a temporary file and renames it over `path`, 
+# so a crash mid-write leaves the previous checkpoint intact, and states 
+# restored from (and still mapping) the previous checkpoint keep their data.
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy
+
+
+MAGIC = b"SYZCKPT1"
+ALIGNMENT = 64
+VERSION = 1
+
+
+def script_hash(script):
+    """Hash of a syzygy script, used to match checkpoints to scripts."""
+    if script is None:
+        return None
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_checkpoint(path, data, header):
+    """
+    Write a checkpoint.
+
+    Args
+        path: Destination file path.
+        data: The raw simulation data (a numpy.ndarray).
+        header: A JSON-serializable dict describing `data`.
+    """
+    data = numpy.ascontiguousarray(data)
+    header = dict(header)
+    header["version"] = VERSION
+    header["dtype"] = data.dtype.str
+    header["shape"] = list(data.shape)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    preamble_size = len(MAGIC) + 4 + len(header_bytes)
+    padding = _aligned(preamble_size) - preamble_size
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as writer:
+            writer.write(MAGIC)
+            writer.write(struct.pack("<I", len(header_bytes)))
+            writer.write(header_bytes)
+            writer.write(b"\0" * padding)
+            writer.write(data.tobytes())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_checkpoint(path, mode="c"):
+    """
+    Read a checkpoint written by `write_checkpoint`.
+
+    Args
+        path: Checkpoint file path.
+        mode: `numpy.memmap` mode. The default ("c", copy-on-write) never
+        writes back to the checkpoint file.
+
+    Returns
+        tuple[dict, numpy.memmap]: The header and the memory-mapped data.
+    """
+    with open(path, "rb") as reader:
+        magic = reader.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"\"{path}\" is not a syzygy checkpoint")
+        header_size, = struct.unpack("<I", reader.read(4))
+        header = json.loads(reader.read(header_size).decode("utf-8"))
+
+    if header.get("version") != VERSION:
+        raise ValueError(f"Unsupported checkpoint version {header.get('version')}")
+
+    offset = _aligned(len(MAGIC) + 4 + header_size)
+    data = numpy.memmap(path,
+                        dtype=numpy.dtype(header["dtype"]),
+                        mode=mode,
+                        offset=offset,
+                        shape=tuple(header["shape"]))
+    return header, data
@@ -8,6 +8,13 @@
 #
 # Note: In light of various revamps of the parser, this module is due for a 
 # rewrite. Ideally, future versions should build during parsing.
+#
+# Particles may be added and removed after construction (see 
+# `SimState.spawn`). The particles are always numbered 0 to 
+# `num_particles() - 1`: removing a particle moves the last particle into its 
+# place. Data arrays may be longer than `sim_size()` (spare capacity); only 
+# their first `sim_size()` entries are used. `version` counts these changes, 
+# so that anything holding particle indices knows when to look them up again.
 
 
 import numpy
@@ -17,6 +24,7 @@ import json
 class DataLayout:
     def __init__(self, particles_list):
       self.particle_metadata = ParticleMetadata(particles_list)
+      self.version = 0
 
 
     def idx_of(self, particle_name=None, prop_name=None, index=0):
@@ -74,6 +82,17 @@ class DataLayout:
         return out
 
 
+    def prop_view(self, data, prop_name):
+        """
+        A (num_particles, prop_size) view of the property `prop_name` in 
+        `data`. The view shares memory with `data`; no copy is made.
+        """
+        prop_offset = self.prop_offset(prop_name)
+        data = data[..., :self.sim_size()]
+        particles = data.reshape(data.shape[:-1] + (self.num_particles(), self.particle_size()))
+        return particles[..., prop_offset:prop_offset + self.prop_size(prop_name)]
+
+
     def num_particles(self) -> int:
         """Number of particles in the simulation"""
         return self.particle_metadata.num_particles
@@ -85,6 +104,60 @@ class DataLayout:
         return self.particle_metadata.particle_size
 
 
+    def add_particle(self, name) -> int:
+        """Add a particle named `name` after the others. Returns its index."""
+        metadata = self.particle_metadata
+        if name in metadata.particle_name_to_idx:
+            raise ValueError(f"A particle named \"{name}\" already exists")
+        index = metadata.num_particles
+        metadata.particle_names.append(name)
+        metadata.particle_name_to_idx[name] = index
+        metadata.num_particles += 1
+        self.version += 1
+        return index
+
+
+    def remove_particle(self, name):
+        """
+        Remove the particle named `name`, moving the last particle into its 
+        place.
+
+        Returns
+            (index, last): The removed particle's index, and the index the 
+            moved particle had (equal to `index` if nothing moved).
+        """
+        metadata = self.particle_metadata
+        if name not in metadata.particle_name_to_idx:
+            raise ValueError(f"No particle named \"{name}\"")
+        index = metadata.particle_name_to_idx.pop(name)
+        last = metadata.num_particles - 1
+        last_name = metadata.particle_names.pop()
+        if index != last:
+            metadata.particle_names[index] = last_name
+            metadata.particle_name_to_idx[last_name] = index
+        metadata.num_particles -= 1
+        self.version += 1
+        return index, last
+
+
+    def set_particle_names(self, names):
+        """Replace the particles with ones named `names`, in that order."""
+        metadata = self.particle_metadata
+        metadata.particle_names = list(names)
+        metadata.particle_name_to_idx = list_inverse(metadata.particle_names)
+        metadata.num_particles = len(metadata.particle_names)
+        self.version += 1
+
+
+    def fresh_particle_name(self, prefix="particle"):
+        """A particle name that isn't taken."""
+        metadata = self.particle_metadata
+        count = metadata.num_particles
+        while f"{prefix}{count}" in metadata.particle_name_to_idx:
+            count += 1
+        return f"{prefix}{count}"
+
+
     def sim_dim(self) -> int:
         return self.prop_size("pos")
 
@@ -92,6 +165,47 @@ class DataLayout:
     def sim_size(self):
         return self.particle_size() * self.num_particles()
 
+
+    def describe(self) -> dict:
+        """
+        A JSON-serializable description of the layout. Two layouts with equal
+        descriptions index the data array identically.
+        """
+        metadata = self.particle_metadata
+        return {
+            "num_particles": metadata.num_particles,
+            "particle_size": metadata.particle_size,
+            "particle_names": list(metadata.particle_names),
+            "prop_names": list(metadata.prop_names),
+            "prop_sizes": list(metadata.prop_sizes),
+            "prop_offsets": list(metadata.prop_offsets),
+        }
+
+    def migrate_data(self, data, old_layout, old_data):
+        """
+        Copy every property of every particle that both this layout and 
+        `old_layout` have (by name, and with the same size) from `old_data` 
+        into `data`. Everything else in `data` is left as it is. Both arrays 
+        may have leading dimensions (e.g. ensemble members).
+        """
+        old_metadata = old_layout.particle_metadata
+        metadata = self.particle_metadata
+        particles = [(metadata.particle_name_to_idx[name], old_metadata.particle_name_to_idx[name])
+                     for name in metadata.particle_names 
+                     if name in old_metadata.particle_name_to_idx]
+        if not particles:
+            return
+        new_idx, old_idx = (list(indices) for indices in zip(*particles))
+        for prop_name in metadata.prop_names:
+            if prop_name not in old_metadata.prop_name_to_idx:
+                continue
+            if old_layout.prop_size(prop_name) != self.prop_size(prop_name):
+                continue
+            prop = self.prop_view(data, prop_name)
+            old_prop = old_layout.prop_view(old_data, prop_name)
+            prop[..., new_idx, :] = old_prop[..., old_idx, :]
+
+
     def state_str(self, data):
         """
         Output the state as a string. Format:
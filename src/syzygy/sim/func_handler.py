@@ -6,42 +6,357 @@
 # A helper class for the SimState class. FuncHandler compiles functions (forces 
 # and updates) and maps functions to their output objects in the global data 
 # array.
+#
+# FuncHandler keeps the generated source of every function. Pickling a 
+# FuncHandler (and so a SimState) stores the sources rather than the compiled 
+# functions, and unpickling re-evaluates them, which is much cheaper than 
+# parsing and compiling the script again.
+#
+# The compiler (and so lark) is only imported when functions are compiled, 
+# not when a pickled FuncHandler is loaded.
+#
+# FuncHandlers may share a kernel cache. Functions carrying a fingerprint 
+# (see `AstBuilder(incremental=True)`) are then compiled once per set of 
+# compiler options and property layout, and later FuncHandlers reuse the 
+# compiled code.
+#
+# Reductions over all particles (`sum(...)` and `mean(...)` in a function) 
+# are compiled to kernels of their own, and their values are stored in the 
+# functions' globals by `compute_reductions`, once per step, so that every 
+# function (and every particle) that uses a reduction reads the same value. 
+# A reduction costs O(N) per step, however many rules use it.
+#
+# By default, every coordinate of a vector rule is a function of its own. 
+# With `vector_kernels`, the coordinates of a rule are compiled to one 
+# function instead, which returns all of them and computes the terms they 
+# share once (see `compile3.compile_vector_tree`). Its output is then a 
+# contiguous slice of the data, `width` values long.
+#
+# With `fuse_pair_forces`, every force with two inputs is compiled into one 
+# function, "pair_forces", which returns the total of the pair forces for 
+# each output, and computes the terms the forces share (e.g. the distance 
+# between the particles) once. The pair loop then makes one call per pair, 
+# and one write per output.
+#
+# Bonds (forces between listed pairs of particles, see `obj_builder.py`) are 
+# compiled to vectorized functions, which `compute_bonds` evaluates for 
+# every listed pair at once, with arrays of particle indices, and 
+# scatter-adds into the outputs. Each bond acts on both of its particles 
+# (like a pair force, which acts on A for every B). A bond costs O(number of 
+# pairs) per step.
+#
+# Collisions (forces between particles in contact, see `obj_builder.py`) are 
+# compiled the same way. Each step, `compute_collisions` finds the candidate 
+# pairs with a sweep-and-prune broad phase (see `sweep_and_prune`), keeps 
+# those closer than the sum of their radii, and evaluates every collision for 
+# them. This costs O(N log N + number of candidates) per step, rather than 
+# the O(N^2) of a pair force. `contact_counts` holds the number of candidates 
+# and contacts found by the last step. In an ensemble, both are summed over 
+# the members (a candidate pair counts once per member), so their ratio means 
+# the same as for a single simulation.
+
+
+import json
+
+import numpy
+
+from syzygy.sim import profiling
+
 
+# Attributes stored when a FuncHandler is pickled. The compiled functions 
+# and their namespace are rebuilt from the sources.
+PICKLED_ATTRIBUTES = (
+    "data_layout", "extra_compiler_options", "extra_namespace",
+    "vector_kernels", "fuse_pair_forces",
+    "force_names", "force_sources", "force_outps", "force_widths",
+    "update_names", "update_sources", "update_outps", "update_widths",
+    "reduction_names", "reduction_kinds", "reduction_sources",
+    "bond_names", "bond_sources", "bond_outps", "bond_widths", "bond_pairs",
+    "collision_names", "collision_sources", "collision_outps", "collision_widths",
+)
 
-from syzygy.compile import compile3
+# Version of the pickled format and of the generated sources. Bump it when 
+# either changes (e.g. when `compile3` generates different code), so that 
+# older pickles (such as those cached by `create_simulation`) aren't used.
+PICKLE_VERSION = 2
 
 
 class FuncHandler:
-    def __init__(self, forces, update_rules, data_layout):
+    def __init__(self, forces, update_rules, data_layout, compiler_options=None,
+                 namespace=None, kernel_cache=None, vector_kernels=False,
+                 fuse_pair_forces=False):
+        """
+        Args
+            forces: Force entries (see `AstBuilder.build_entire_ast`).
+            update_rules: Update rule entries.
+            data_layout: The simulation's `DataLayout`.
+            compiler_options: Extra options passed to `compile3.compile_tree` 
+            for every function.
+            namespace: Extra globals visible to the compiled functions.
+            kernel_cache: A dict shared by FuncHandlers whose compiled 
+            functions may be reused (see the top of this module).
+            vector_kernels: Compile each vector rule to one function (see 
+            the top of this module).
+            fuse_pair_forces: Compile all pair forces to one function (see 
+            the top of this module).
+        """
+        self.extra_compiler_options = compiler_options or {}
+        self.extra_namespace = namespace or {}
+        self.namespace = create_namespace(self.extra_namespace)
+        self.kernel_cache = kernel_cache
+        # Keys of the `kernel_cache` entries used by this FuncHandler.
+        self.used_kernels = set()
+        self.vector_kernels = vector_kernels
+        self.fuse_pair_forces = fuse_pair_forces
+        self.data_layout = data_layout
+        self.force_sources = []
+        self.update_sources = []
+        self.reduction_names = []
+        self.reduction_kinds = []
+        self.reduction_sources = []
+        self.reduction_funcs = []
+        self.bond_names = []
+        self.bond_sources = []
+        self.bond_funcs = []
+        self.bond_outps = []
+        self.bond_widths = []
+        self.bond_pairs = []
+        self._bond_index_cache = {}
+        self.collision_names = []
+        self.collision_sources = []
+        self.collision_funcs = []
+        self.collision_outps = []
+        self.collision_widths = []
+        self.contact_counts = {"candidates": 0, "contacts": 0}
         self.process_forces(forces, data_layout)
         self.process_update_rules(update_rules, data_layout)
-        self.data_layout = data_layout
 
 
     def forces(self, particle_index):
         """
-        Generates a sequence of (index, function) pairs where `index` points to 
-        the position in the raw simulation data array corresponding to the 
-        output of `function`.
+        Generates a sequence of (function, index, width) triples where `index` 
+        points to the position in the raw simulation data array corresponding 
+        to the output of `function`. `width` is the number of values the 
+        function returns, or None if it returns a single value.
         """
-        for func, outp in zip(self.force_funcs, self.force_outps):
-            yield func, self.data_layout.particle_size() * particle_index + outp
+        for func, outp, width in zip(self.force_funcs, self.force_outps, self.force_widths):
+            yield func, self.data_layout.particle_size() * particle_index + outp, width
     
 
+    def split_forces(self, wrap=None):
+        """
+        The forces as two lists of (function, output offset, width) triples: 
+        forces with two inputs (A, B), and forces with one input.
+
+        Args
+            wrap: If not None, each function is replaced by 
+            `wrap(k, function)`, where `k` is its index in `force_funcs` 
+            (e.g. `StepProfile.timed_force`).
+        """
+        pair_forces = []
+        single_forces = []
+        for k, (func, outp, width) in enumerate(zip(self.force_funcs, self.force_outps, 
+                                                    self.force_widths)):
+            # (A, B, data) or (A, data)
+            is_pair_force = func.__code__.co_argcount == 3
+            if wrap is not None:
+                func = wrap(k, func)
+            if is_pair_force:
+                pair_forces.append((func, outp, width))
+            else:
+                single_forces.append((func, outp, width))
+        return pair_forces, single_forces
+
+
+    def update_rules(self, wrap=None):
+        """
+        The update rules as a list of (function, output offset, width) 
+        triples (see `split_forces`).
+        """
+        rules = []
+        for k, (func, outp, width) in enumerate(zip(self.update_funcs, self.update_outps, 
+                                                    self.update_widths)):
+            if wrap is not None:
+                func = wrap(k, func)
+            rules.append((func, outp, width))
+        return rules
+
+
     def updates(self, particle_index):
         """
-        Generates a sequence of (index, function) pairs where `index` points to 
-        the position in the raw simulation data array corresponding to the 
-        output of `function`.
+        Generates a sequence of (function, index, width) triples (see 
+        `forces`).
         """
-        for func, outp in zip(self.update_funcs, self.update_outps):
-            yield func, self.data_layout.particle_size() * particle_index + outp
+        for func, outp, width in zip(self.update_funcs, self.update_outps, self.update_widths):
+            yield func, self.data_layout.particle_size() * particle_index + outp, width
+
+
+    def force_output_offsets(self):
+        """Offsets (within a particle) of every value the forces write."""
+        offsets = set()
+        for outp, width in zip(self.force_outps + self.bond_outps + self.collision_outps, 
+                               self.force_widths + self.bond_widths + self.collision_widths):
+            offsets.update(range(outp, outp + (width or 1)))
+        return sorted(offsets)
+
+
+    def compute_bonds(self, forces_data, data):
+        """Add the forces of every bond to `forces_data`."""
+        particle_size = self.data_layout.particle_size()
+        for func, outp, width, pairs in zip(self.bond_funcs, self.bond_outps, 
+                                            self.bond_widths, self.bond_pairs):
+            first, second = self._bond_indices(pairs)
+            if len(first) == 0:
+                continue
+            values = func(first, second, data)
+            if width is None:
+                values = (values,)
+            targets = first * particle_size + outp
+            for value in values:
+                numpy.add.at(forces_data, targets, value)
+                targets = targets + 1
+
+
+    def compute_collisions(self, num_particles, forces_data, data):
+        """
+        Add the forces of every collision to `forces_data`, and update 
+        `contact_counts`.
+        """
+        if not self.collision_funcs:
+            return
+        first, second, touching = self._contacts(num_particles, data)
+        if len(first) == 0:
+            return
+        particle_size = self.data_layout.particle_size()
+        for func, outp, width in zip(self.collision_funcs, self.collision_outps, 
+                                     self.collision_widths):
+            values = func(first, second, data)
+            if width is None:
+                values = (values,)
+            targets = first * particle_size + outp
+            for value in values:
+                numpy.add.at(forces_data, targets, numpy.where(touching, value, 0))
+                targets = targets + 1
+
+
+    def _contacts(self, num_particles, data):
+        """
+        The pairs of particles in contact, as two arrays of indices (first and 
+        second particle) with every pair in both orders, and whether each pair 
+        is in contact. In an ensemble, a pair is kept if it is in contact in 
+        any member, and the last array (one column per member) says in which.
+        """
+        layout = self.data_layout
+        starts = numpy.arange(num_particles) * layout.particle_size()
+        pos_offset = layout.prop_offset("pos")
+        # (num_particles, dim), and (num_particles,), with a trailing member 
+        # axis in ensembles.
+        pos = numpy.stack([data[starts + pos_offset + c] 
+                           for c in range(layout.prop_size("pos"))], axis=1)
+        radius = data[starts + layout.prop_offset("radius")]
+
+        # Broad phase
+        if radius.ndim == 1:
+            pairs = sweep_and_prune(pos, radius)
+        else:
+            pairs = numpy.unique(numpy.concatenate(
+                    [sweep_and_prune(pos[..., k], radius[:, k]) 
+                     for k in range(radius.shape[1])]), axis=0)
+        first, second = pairs[:, 0], pairs[:, 1]
+
+        # Narrow phase
+        gap = pos[first] - pos[second]
+        reach = radius[first] + radius[second]
+        touching = (gap * gap).sum(axis=1) < reach * reach
+        # One test per candidate (and member, in ensembles).
+        self.contact_counts = {"candidates": int(touching.size), 
+                               "contacts": int(touching.sum())}
+
+        keep = touching if touching.ndim == 1 else touching.any(axis=1)
+        first, second, touching = first[keep], second[keep], touching[keep]
+        return (numpy.concatenate([first, second]), 
+                numpy.concatenate([second, first]), 
+                numpy.concatenate([touching, touching]))
+
+
+    def _bond_indices(self, pairs):
+        """
+        The indices of the particles in `pairs`, as two arrays (first and 
+        second particle), with every pair in both orders. Pairs with a 
+        particle that has been despawned are left out.
+        """
+        version = self.data_layout.version
+        cached = self._bond_index_cache.get(id(pairs))
+        if cached is None or cached[0] != version:
+            indices = self.data_layout.particle_metadata.particle_name_to_idx
+            pair_indices = numpy.array([(indices[a], indices[b]) for a, b in pairs 
+                                        if a in indices and b in indices], 
+                                       dtype=numpy.intp).reshape(-1, 2)
+            first = numpy.concatenate([pair_indices[:, 0], pair_indices[:, 1]])
+            second = numpy.concatenate([pair_indices[:, 1], pair_indices[:, 0]])
+            cached = (version, first, second)
+            self._bond_index_cache[id(pairs)] = cached
+        return cached[1], cached[2]
+
+
+    def compute_reductions(self, num_particles, dt, data):
+        """
+        Evaluate every reduction over the first `num_particles` particles, 
+        and store the results where the compiled functions read them.
+        """
+        if not self.reduction_funcs:
+            return
+        indices = numpy.arange(num_particles)
+        for name, kind, func in zip(self.reduction_names, self.reduction_kinds, 
+                                    self.reduction_funcs):
+            values = func(indices, dt, data)
+            if numpy.ndim(values) == numpy.ndim(data):
+                total = values.sum(axis=0)
+            else:
+                # The body doesn't depend on the particle.
+                total = num_particles * values
+            if kind == "mean":
+                total = total / max(num_particles, 1)
+            self.namespace[name] = total
+
+
+    def __getstate__(self):
+        """Pickle the generated sources, not the compiled functions."""
+        state = {name: getattr(self, name) for name in PICKLED_ATTRIBUTES}
+        state["pickle_version"] = PICKLE_VERSION
+        return state
+
+
+    def __setstate__(self, state):
+        """Unpickle, evaluating the generated sources again."""
+        state = dict(state)
+        if state.pop("pickle_version", None) != PICKLE_VERSION:
+            raise ValueError("FuncHandler was pickled by an incompatible version "
+                             "of syzygy")
+        self.__dict__.update(state)
+        self.kernel_cache = None
+        self.used_kernels = set()
+        self.namespace = create_namespace(self.extra_namespace)
+
+        def evaluate(sources):
+            return [eval(source, self.namespace) for source in sources]
+
+        self.force_funcs = evaluate(self.force_sources)
+        self.update_funcs = evaluate(self.update_sources)
+        self.reduction_funcs = evaluate(self.reduction_sources)
+        for name in self.reduction_names:
+            self.namespace[name] = 0.0
+        self.bond_funcs = evaluate(self.bond_sources)
+        self._bond_index_cache = {}
+        self.collision_funcs = evaluate(self.collision_sources)
+        self.contact_counts = {"candidates": 0, "contacts": 0}
 
 
     def process_forces(self, forces, data_layout):
         force_names = []
         force_funcs = []
         force_outps = []
+        force_widths = []
 
         compiler_options = {
             "variables_predefined": True,
@@ -49,19 +364,22 @@ class FuncHandler:
             "particle_metadata": data_layout.particle_metadata,
             "variables": ["A", "B", "data"],
         }
+        compiler_options.update(self.extra_compiler_options)
 
         self._compile_forces(forces, force_names, force_funcs, 
-                            force_outps, compiler_options, data_layout)
+                            force_outps, force_widths, compiler_options, data_layout)
 
         self.force_funcs = force_funcs
         self.force_names = force_names
         self.force_outps = force_outps
+        self.force_widths = force_widths
             
 
     def process_update_rules(self, update_rules, data_layout):
         update_rule_names = []
         update_rule_funcs = []
         update_rule_outps = []
+        update_rule_widths = []
                     
         compiler_options = {
             "variables_predefined": True,
@@ -69,64 +387,270 @@ class FuncHandler:
             "output_lang": "py",
             "particle_metadata": data_layout.particle_metadata,
         }
+        compiler_options.update(self.extra_compiler_options)
         
         self._compile_update_rules(update_rules, update_rule_names, 
                                    update_rule_funcs, update_rule_outps,
-                                   compiler_options, data_layout)
+                                   update_rule_widths, compiler_options, data_layout)
 
         self.update_funcs = update_rule_funcs
         self.update_names = update_rule_names
         self.update_outps = update_rule_outps
+        self.update_widths = update_rule_widths
 
 
 
     def _compile_forces(self, force_entries, force_names, force_funcs, 
-                       force_outps, compiler_options, data_layout):
+                       force_outps, force_widths, compiler_options, data_layout):
+        # Bonds are compiled separately.
+        self._compile_bonds([entry for entry in force_entries if "pairs" in entry], 
+                            dict(compiler_options), data_layout)
+        force_entries = [entry for entry in force_entries if "pairs" not in entry]
+        # So are collisions.
+        self._compile_collisions([entry for entry in force_entries if "contact" in entry], 
+                                 dict(compiler_options), data_layout)
+        force_entries = [entry for entry in force_entries if "contact" not in entry]
+
         # Compile all forces.
-        for entry in force_entries:
-            compiler_options["func_name"] = entry["name"]
+        kernels = self._kernels(force_entries)
+        if self.fuse_pair_forces:
+            pair_entries = [entry for entry in force_entries if len(entry["inputs"]) == 2]
+            kernels = self._kernels([entry for entry in force_entries 
+                                     if len(entry["inputs"]) != 2])
+            if pair_entries:
+                kernels.append(self._fused_pair_kernel(pair_entries, data_layout))
+        for entry, code, width, fingerprint in kernels:
+            compiler_options["func_name"] = entry["rule"] if width else entry["name"]
             compiler_options["variables"] = entry["inputs"] + ["data"]
-            self._compile_force(entry["func"], compiler_options, 
-                               force_names, force_funcs)
+            self._compile_force(code, compiler_options, 
+                               force_names, force_funcs, fingerprint)
             # Assign force to an output variable (net-force).
             self.assign_outp(entry, force_outps, data_layout)
+            force_widths.append(width)
+
+
+    def _compile_bonds(self, bond_entries, compiler_options, data_layout):
+        # Bonds are evaluated for arrays of pairs.
+        compiler_options["vectorize"] = True
+        names = data_layout.particle_metadata.particle_name_to_idx
+        for entry, code, width, fingerprint in self._kernels(bond_entries):
+            for a, b in entry["pairs"]:
+                if a not in names or b not in names:
+                    raise Exception(f"Bond \"{entry['rule']}\" between unknown particles "
+                                    f"\"{a}\" and \"{b}\"")
+                if a == b:
+                    raise Exception(f"Bond \"{entry['rule']}\" between \"{a}\" and itself")
+            compiler_options["func_name"] = entry["rule"] if width else entry["name"]
+            compiler_options["variables"] = entry["inputs"] + ["data"]
+            name, source, func = self._compile(code, compiler_options, fingerprint)
+            self.bond_names.append(name)
+            self.bond_sources.append(source)
+            self.bond_funcs.append(func)
+            self.assign_outp(entry, self.bond_outps, data_layout)
+            self.bond_widths.append(width)
+            self.bond_pairs.append(entry["pairs"])
+
+
+    def _compile_collisions(self, collision_entries, compiler_options, data_layout):
+        # Collisions are evaluated for arrays of pairs in contact.
+        compiler_options["vectorize"] = True
+        if collision_entries and "radius" not in data_layout.particle_metadata.prop_name_to_idx:
+            raise Exception("Collisions need particles with a \"radius\" property")
+        for entry, code, width, fingerprint in self._kernels(collision_entries):
+            compiler_options["func_name"] = entry["rule"] if width else entry["name"]
+            compiler_options["variables"] = entry["inputs"] + ["data"]
+            name, source, func = self._compile(code, compiler_options, fingerprint)
+            self.collision_names.append(name)
+            self.collision_sources.append(source)
+            self.collision_funcs.append(func)
+            self.assign_outp(entry, self.collision_outps, data_layout)
+            self.collision_widths.append(width)
 
 
     def _compile_update_rules(self, update_rules, update_rule_names, 
                              update_rule_funcs, update_rule_outps, 
-                             compiler_options, data_layout):
+                             update_rule_widths, compiler_options, data_layout):
         # Compile all update_rules.
-        for entry in update_rules:
+        for entry, code, width, fingerprint in self._kernels(update_rules):
             # Compile.
-            compiler_options["func_name"] = entry["name"]
+            compiler_options["func_name"] = entry["rule"] if width else entry["name"]
             compiler_options["variables"] = entry["inputs"] + ["dt", "data"]
-            self._compile_update_rule(entry["func"], 
+            self._compile_update_rule(code, 
                                       compiler_options, 
                                       update_rule_names, 
-                                      update_rule_funcs)
+                                      update_rule_funcs,
+                                      fingerprint)
             # Assign force to an output variable (net-force).
             self.assign_outp(entry, update_rule_outps, data_layout)
+            update_rule_widths.append(width)
+
+
+    def _kernels(self, entries):
+        """
+        Group coordinate function entries into the functions to compile.
+
+        Returns
+            list[tuple]: (first entry, code, width, fingerprint) per function. 
+            `code` is a shaped tree, or with `width` set, a list of the shaped 
+            trees of a rule's coordinates.
+        """
+        groups = []
+        for entry in entries:
+            if self.vector_kernels and groups and self._continues(groups[-1][-1], entry):
+                groups[-1].append(entry)
+            else:
+                groups.append([entry])
+
+        kernels = []
+        for group in groups:
+            if len(group) == 1:
+                kernels.append((group[0], group[0]["func"], None, group[0].get("fingerprint")))
+                continue
+            fingerprints = [entry.get("fingerprint") for entry in group]
+            fingerprint = None if None in fingerprints else "+".join(fingerprints)
+            kernels.append((group[0], [entry["func"] for entry in group], len(group), 
+                            fingerprint))
+        return kernels
+
+
+    def _fused_pair_kernel(self, entries, data_layout):
+        """
+        The pair forces `entries` as one function (see `_kernels`). Its 
+        coordinates are the sums of the forces on each output, from the 
+        first output to the last (outputs that no force writes are 0).
+        """
+        from syzygy.compile import compile3
+
+        outputs = {}
+        rules = {}
+        for entry in entries:
+            # One pair of particle names, and distinct `let` names per rule.
+            rule = rules.setdefault(entry.get("rule", entry["name"]), len(rules))
+            tree = compile3.rename(entry["func"], dict(zip(entry["inputs"], ["A", "B"])), 
+                                   f"_f{rule}")
+            outp = data_layout.idx_of(prop_name=entry["output"]["property_name"], 
+                                      index=entry["output"]["property_index"])
+            outputs.setdefault(outp, ([], entry))[0].append(tree)
+
+        first, last = min(outputs), max(outputs)
+        code = [compile3.sum_trees(outputs.get(outp, ([], None))[0]) 
+                for outp in range(first, last + 1)]
+        fused = {
+            "name": "pair_forces",
+            "rule": "pair_forces",
+            "inputs": ["A", "B"],
+            "output": outputs[first][1]["output"],
+        }
+        fingerprints = [entry.get("fingerprint") for entry in entries]
+        fingerprint = None
+        if None not in fingerprints:
+            fingerprint = "pair_forces:" + "+".join(fingerprints)
+        return fused, code, len(code), fingerprint
+
 
+    def _continues(self, previous, entry):
+        """Whether `entry` is the coordinate after `previous`, of the same rule."""
+        return (entry.get("rule") is not None 
+                and entry.get("rule") == previous.get("rule")
+                and entry["output"]["property_name"] == previous["output"]["property_name"]
+                and entry["output"]["property_index"] == previous["output"]["property_index"] + 1)
 
-    def _compile_force(self, force_code, compiler_options, force_names, force_funcs):
+
+    def _compile_force(self, force_code, compiler_options, force_names, force_funcs,
+                       fingerprint=None):
             # Compile.
-            force_name, force_func = compile3.compile_tree(force_code,
-                    compiler_options=compiler_options)
+            force_name, force_source, force_func = self._compile(
+                    force_code, compiler_options, fingerprint)
             # Append to lists.
             force_names.append(force_name)
-            force_funcs.append(eval(force_func))
+            force_funcs.append(force_func)
+            self.force_sources.append(force_source)
 
 
     def _compile_update_rule(self, update_rule_code, compiler_options,
-                             update_rule_names, update_rule_funcs):
-            
+                             update_rule_names, update_rule_funcs, 
+                             fingerprint=None):
             # Compile.
-            update_rule_name, update_rule_func = compile3.compile_tree(
-                    update_rule_code, compiler_options=compiler_options)
+            update_rule_name, update_rule_source, update_rule_func = self._compile(
+                    update_rule_code, compiler_options, fingerprint)
 
             # Append to lists.
             update_rule_names.append(update_rule_name)
-            update_rule_funcs.append(eval(update_rule_func))
+            update_rule_funcs.append(update_rule_func)
+            self.update_sources.append(update_rule_source)
+
+
+    def _compile(self, code, compiler_options, fingerprint=None):
+        """
+        Compile and evaluate one function, or reuse it from the kernel cache.
+
+        Returns
+            (name, source, function)
+        """
+        key = None
+        if self.kernel_cache is not None and fingerprint is not None:
+            key = (fingerprint, self._options_key(compiler_options))
+            self.used_kernels.add(key)
+            if key in self.kernel_cache:
+                name, source, code_object, reductions = self.kernel_cache[key]
+                report = profiling.startup_report()
+                if report is not None:
+                    report.count("reused_kernels")
+                self._add_reductions(reductions)
+                return name, source, self._eval(code_object)
+
+        from syzygy.compile import compile3
+        reductions = []
+        compile_function = compile3.compile_tree
+        if isinstance(code, list):
+            compile_function = compile3.compile_vector_tree
+        with profiling.startup_phase("compile"):
+            name, source = compile_function(
+                    code, compiler_options=dict(compiler_options, reductions=reductions))
+        with profiling.startup_phase("eval"):
+            code_object = compile(source, "<syzygy>", "eval")
+        if key is not None:
+            self.kernel_cache[key] = (name, source, code_object, reductions)
+        self._add_reductions(reductions)
+        return name, source, self._eval(code_object)
+
+
+    def _add_reductions(self, reductions):
+        """
+        Add the reductions a function uses, as (name, kind, source) triples 
+        (see `compile3`), unless another function already added them.
+        """
+        for name, kind, source in reductions:
+            if name in self.reduction_names:
+                continue
+            self.reduction_names.append(name)
+            self.reduction_kinds.append(kind)
+            self.reduction_sources.append(source)
+            self.reduction_funcs.append(self._eval(source))
+            self.namespace[name] = 0.0
+
+
+    def _options_key(self, compiler_options):
+        """
+        Everything besides the function itself that the generated code 
+        depends on: the compiler options and where properties are stored.
+        """
+        options = {key: value for key, value in compiler_options.items() 
+                   if key != "particle_metadata"}
+        metadata = self.data_layout.particle_metadata
+        return json.dumps([options, metadata.particle_size, list(metadata.prop_names), 
+                           list(metadata.prop_offsets), list(metadata.prop_sizes)], 
+                          sort_keys=True, default=str)
+
+
+    def _eval(self, source):
+        """Evaluate generated source (or its compiled code) to a function."""
+        with profiling.startup_phase("eval"):
+            func = eval(source, self.namespace)
+        report = profiling.startup_report()
+        if report is not None:
+            report.count("kernels")
+        return func
 
 
     def assign_outp(self, update_rule_entry, update_rule_outps, data_layout):
@@ -135,3 +659,43 @@ class FuncHandler:
 
         update_rule_outps.append(data_layout.idx_of(
             prop_name=outp["property_name"], index=outp["property_index"]))
+
+
+def create_namespace(extra_namespace):
+    """Globals for the compiled functions."""
+    namespace = {"numpy": numpy}
+    namespace.update(extra_namespace)
+    return namespace
+
+
+def sweep_and_prune(pos, radius):
+    """
+    Broad phase collision detection. Sorts the particles by where they start 
+    along the axis their positions are most spread out along, and pairs 
+    every particle with the particles that start before it ends.
+
+    Args
+        pos: (num_particles, dim) positions.
+        radius: (num_particles,) radii.
+
+    Returns
+        numpy.ndarray: (num_candidates, 2) indices of the candidate pairs, 
+        each pair once (smaller index first). Every pair of touching 
+        particles is a candidate.
+    """
+    num_particles = len(radius)
+    if num_particles < 2:
+        return numpy.zeros((0, 2), dtype=numpy.intp)
+    axis = numpy.argmax(pos.var(axis=0))
+    low = pos[:, axis] - radius
+    order = numpy.argsort(low, kind="stable")
+    low = low[order]
+    high = (pos[:, axis] + radius)[order]
+
+    # In sorted order, particle k overlaps particles k + 1, ..., end[k] - 1.
+    end = numpy.searchsorted(low, high, side="right")
+    counts = numpy.maximum(end - numpy.arange(1, num_particles + 1), 0)
+    first = numpy.repeat(numpy.arange(num_particles), counts)
+    run_starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    second = first + 1 + numpy.arange(len(first)) - run_starts
+    return numpy.sort(numpy.stack([order[first], order[second]], axis=1), axis=1)
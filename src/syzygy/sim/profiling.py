@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+#
+#
+# Runtime profiles of `SimState.step`. A `StepProfile` accumulates wall time
+# and call counts for each compiled force and update rule (named as in
+# `FuncHandler.force_names` and `FuncHandler.update_names`), and for each
+# phase of a step:
+#
+#   * "reductions": `sum` and `mean` over all particles
+#   * "pair_forces": forces with two inputs (A, B)
+#   * "bonds": forces between listed pairs (see `FuncHandler.compute_bonds`)
+#   * "collisions": collision detection, and forces between particles in 
+#     contact (see `FuncHandler.compute_collisions`)
+#   * "forces": forces with one input
+#   * "updates": update rules
+#   * "refresh": copying fresh data into the simulation data
+#   * "zero": zeroing `net_force`
+#
+# It also counts the candidate pairs and contacts found by collision 
+# detection.
+#
+# A profiled step runs the same code as any other step, with each compiled 
+# function wrapped to time its calls (see `StepProfile.timed_force`), and 
+# each phase timed by `phase_timer`. See 
+# `SimStatePythonLambdas.enable_profiling`.
+#
+# A `StartupReport` records where the time goes while a simulation is built
+# (see `create_simulation`), phase by phase:
+#
+#   * "grammar": loading the grammar and generating the parsers
+#   * "parse_objects": parsing the script's particles and functions
+#   * "metadata": `ParticleMetadataBuilder`
+#   * "parse_functions": parsing each function body
+#   * "shape": `LinearAlgebraChecker2`
+#   * "compile": `compile3` generating source
+#   * "eval": evaluating the generated source
+#
+# along with the sizes that drive them: particles, functions, syntax tree 
+# nodes before and after shaping, and compiled kernels. The phases are 
+# recorded by whichever code is running while a report is being collected 
+# (see `collecting`); outside of that, `startup_phase` does nothing. Each 
+# thread collects its own report, so simulations built at the same time 
+# (e.g. by `SessionManager.compile` on executor threads) don't mix theirs.
+
+import contextlib
+import threading
+import time
+
+import numpy
+
+
+clock = time.perf_counter
+
+
+PHASES = ("reductions", "pair_forces", "bonds", "collisions", "forces", "updates", 
+          "refresh", "zero")
+
+COUNTS = ("candidates", "contacts")
+
+
+class StepProfile:
+    def __init__(self, force_names, update_names):
+        self.force_names = list(force_names)
+        self.update_names = list(update_names)
+        self.reset()
+
+
+    def reset(self):
+        self.steps = 0
+        self.force_times = numpy.zeros(len(self.force_names))
+        self.force_calls = numpy.zeros(len(self.force_names), dtype=numpy.int64)
+        self.update_times = numpy.zeros(len(self.update_names))
+        self.update_calls = numpy.zeros(len(self.update_names), dtype=numpy.int64)
+        self.phase_times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+
+    def phase(self, phase):
+        """Add the time spent in the `with` block to `phase`."""
+        return _Timer(self.phase_times, phase)
+
+
+    def timed_force(self, k, func):
+        """`func`, the `k`th force, adding its time and calls to this profile."""
+        return _timed(func, self.force_times, self.force_calls, k)
+
+
+    def timed_update(self, k, func):
+        """`func`, the `k`th update rule (see `timed_force`)."""
+        return _timed(func, self.update_times, self.update_calls, k)
+
+
+    def add_counts(self, counts):
+        for name, amount in counts.items():
+            self.counts[name] += amount
+
+
+    def copy(self):
+        profile = StepProfile(self.force_names, self.update_names)
+        profile.steps = self.steps
+        profile.force_times[:] = self.force_times
+        profile.force_calls[:] = self.force_calls
+        profile.update_times[:] = self.update_times
+        profile.update_calls[:] = self.update_calls
+        profile.phase_times = dict(self.phase_times)
+        profile.counts = dict(self.counts)
+        return profile
+
+
+    def add(self, other):
+        """Accumulate another profile of the same functions into this one."""
+        self.steps += other.steps
+        self.force_times += other.force_times
+        self.force_calls += other.force_calls
+        self.update_times += other.update_times
+        self.update_calls += other.update_calls
+        for phase, seconds in other.phase_times.items():
+            self.phase_times[phase] += seconds
+        self.add_counts(other.counts)
+
+
+    def report(self):
+        """
+        The profile as plain data:
+
+            {
+                "steps": <number of steps profiled>,
+                "phases": {<phase>: <seconds>, ...},
+                "counts": {"candidates", "contacts"},
+                "forces": [{"name", "time", "calls"}, ...],
+                "updates": [{"name", "time", "calls"}, ...],
+            }
+
+        Rules are sorted by time, slowest first.
+        """
+        def rules(names, times, calls):
+            entries = [{"name": name, "time": float(time), "calls": int(count)}
+                       for name, time, count in zip(names, times, calls)]
+            return sorted(entries, key=lambda entry: entry["time"], reverse=True)
+
+        return {
+            "steps": self.steps,
+            "phases": dict(self.phase_times),
+            "counts": dict(self.counts),
+            "forces": rules(self.force_names, self.force_times, self.force_calls),
+            "updates": rules(self.update_names, self.update_times, self.update_calls),
+        }
+
+
+    def __str__(self):
+        report = self.report()
+        lines = [f"{report['steps']} steps"]
+        for phase, seconds in report["phases"].items():
+            lines.append(f"  {phase:<12} {seconds:10.6f}s")
+        for name, amount in report["counts"].items():
+            lines.append(f"  {name:<12} {amount:>10}")
+        for kind in ("forces", "updates"):
+            lines.append(f"  {kind}")
+            for entry in report[kind]:
+                lines.append(f"    {entry['name']:<20} {entry['time']:10.6f}s "
+                             f"{entry['calls']:>10} calls")
+        return "\n".join(lines)
+
+
+class _Timer:
+    """Adds the time spent in a `with` block to `times[key]`."""
+    def __init__(self, times, key):
+        self.times = times
+        self.key = key
+
+
+    def __enter__(self):
+        self.start = clock()
+
+
+    def __exit__(self, *exc_info):
+        self.times[self.key] += clock() - self.start
+
+
+def _timed(func, times, calls, k):
+    def timed_func(*args):
+        start = clock()
+        try:
+            return func(*args)
+        finally:
+            times[k] += clock() - start
+            calls[k] += 1
+    return timed_func
+
+
+def phase_timer(profile):
+    """
+    `profile.phase`, or if `profile` is None, a function returning a context 
+    manager that does nothing.
+    """
+    if profile is None:
+        return _no_phase
+    return profile.phase
+
+
+def _no_phase(phase):
+    return _NULL_CONTEXT
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+STARTUP_PHASES = ("grammar", "parse_objects", "metadata", "parse_functions", 
+                  "shape", "compile", "eval")
+
+
+class StartupReport:
+    def __init__(self):
+        self.total = 0.0
+        self.phase_times = dict.fromkeys(STARTUP_PHASES, 0.0)
+        self.sizes = {}
+
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+
+    def count(self, name, amount=1):
+        self.sizes[name] = self.sizes.get(name, 0) + amount
+
+
+    def report(self):
+        """
+        The report as plain data:
+
+            {
+                "total": <seconds>,
+                "phases": {<phase>: <seconds>, ..., "other": <seconds>},
+                "sizes": {"particles", "functions", "nodes_before_shaping",
+                          "nodes_after_shaping", "kernels", ...},
+            }
+        """
+        phases = dict(self.phase_times)
+        phases["other"] = max(0.0, self.total - sum(self.phase_times.values()))
+        return {"total": self.total, "phases": phases, "sizes": dict(self.sizes)}
+
+
+    def __str__(self):
+        report = self.report()
+        lines = [f"startup {report['total']:.6f}s"]
+        for phase, seconds in report["phases"].items():
+            lines.append(f"  {phase:<16} {seconds:10.6f}s")
+        for name, amount in report["sizes"].items():
+            lines.append(f"  {name:<24} {amount:>10}")
+        return "\n".join(lines)
+
+
+# The `StartupReport` being collected by each thread (`report`), if any.
+_collecting = threading.local()
+
+
+@contextlib.contextmanager
+def collecting(report):
+    """
+    Record startup phases into `report` (a `StartupReport`) for the duration 
+    of the `with` block, and add the block's duration to `report.total`.
+    """
+    previous = startup_report()
+    _collecting.report = report
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.total += time.perf_counter() - start
+        _collecting.report = previous
+
+
+def startup_report():
+    """The `StartupReport` being collected by this thread, or None."""
+    return getattr(_collecting, "report", None)
+
+
+@contextlib.contextmanager
+def startup_phase(phase):
+    """Time the `with` block as `phase` of the report being collected."""
+    report = startup_report()
+    if report is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_time(phase, time.perf_counter() - start)
+
+
+def count_nodes(tree):
+    """The number of nodes (subtrees and tokens) in a lark tree."""
+    count = 0
+    for subtree in tree.iter_subtrees():
+        count += 1 + sum(not hasattr(child, "data") for child in subtree.children)
+    return count
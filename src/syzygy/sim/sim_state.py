@@ -18,29 +18,177 @@
 #   * `DataLayout` handles the particles
 #   * `FuncHandler` handles the functions (forces and update rules)
 #
+# The simulation data is float64 by default. The `dtype` option stores it 
+# with another precision (e.g. float32, for half the memory traffic), and 
+# `accumulator_dtype` sums forces in a separate, higher precision array 
+# before storing them in the data.
+#
+# `SimStateEnsemble` steps many copies ("members") of one simulation at once, 
+# each with its own data, as one (ensemble_size, sim_size) array.
+#
+# `SimState` objects can be pickled (e.g. to send them to worker processes); 
+# only the generated source of their functions is stored (see 
+# `func_handler.py`).
+#
+# A `SimState` can be written to a binary checkpoint with `checkpoint` and 
+# resumed with `SimState.restore` (see `checkpoint.py`).
+#
+# Particles can be added and removed while the simulation runs (`spawn` and 
+# `despawn`). The data arrays have spare capacity, which doubles when it runs 
+# out, and removing a particle moves the last particle into its place, so 
+# both are amortized O(1). The functions only ever loop over the first 
+# `num_particles()` particles.
+#
+# `SimState.reload` swaps in the functions (and particles) of an edited 
+# script between two steps, keeping the current values of every property 
+# that is still there.
+#
+# Importing this module, and loading and stepping a pickled `SimState`, only 
+# needs numpy. The parser (and lark) is imported by `create_simulation`.
+#
+
+import hashlib
+import json
+import os
+import pickle
+import threading
 
 import numpy
-from syzygy.parse import parse
 from syzygy.sim import data_layout
 from syzygy.sim import func_handler
-
-import inspect
-
-import time
+from syzygy.sim import checkpoint
+from syzygy.sim import profiling
 
 
 
 class SimState:
-    def __init__(self, particles: list, forces: list, updates: list):
+    def __init__(self, particles: list, forces: list, updates: list, 
+                 dtype="float64", accumulator_dtype=None):
+        """
+        Args
+            dtype: Floating point type of the simulation data.
+            accumulator_dtype: If not None, floating point type in which 
+            forces are summed before being stored in the data.
+        """
+        self.dtype = float_dtype(dtype)
+        self.accumulator_dtype = None
+        if accumulator_dtype is not None:
+            self.accumulator_dtype = float_dtype(accumulator_dtype)
         self.data_layout = data_layout.DataLayout(particles)
-        self._data = numpy.zeros(self.data_layout.sim_size(), dtype=numpy.float64)
+        self._data = numpy.zeros(self.data_layout.sim_size(), dtype=self.dtype)
         self._fresh_data = self._data.copy()
         self.data_layout.init_data(self._data, particles)
+        # Time elapsed since the start of the simulation.
+        self._time = 0.0
+        # The script this state was built from (set by `create_simulation`).
+        self.script = None
+        # The directory files named in `script` are read from (None if the 
+        # script may not read files), and the SHA-256 of each file it read.
+        self.script_dir = None
+        self.files = {}
+        # Keyword arguments to pass to the constructor to rebuild this state 
+        # from `script` (must be JSON-serializable).
+        self.options = {}
+        # Names of the particles added by `spawn` (rather than by the script).
+        self.spawned = set()
+        # Names of the script's particles removed by `despawn`.
+        self.despawned = set()
+        if self.dtype != numpy.float64:
+            self.options["dtype"] = self.dtype.name
+        if self.accumulator_dtype is not None:
+            self.options["accumulator_dtype"] = self.accumulator_dtype.name
 
 
     def data(self):
         """Raw simulation data"""
-        return self._data
+        return self._data[..., :self.data_layout.sim_size()]
+
+
+    def capacity(self):
+        """Number of particles the data arrays have room for."""
+        return self._data.shape[-1] // self.data_layout.particle_size()
+
+
+    def spawn(self, name=None, **props):
+        """
+        Add a particle. Amortized O(1).
+
+        Args
+            name: The particle's name. Defaults to an unused name.
+            props: Property values (e.g. `pos=[0, 0, 1]`). Properties that 
+            aren't given start at zero. For ensembles, a value may also 
+            have shape (ensemble_size,) or (ensemble_size, prop_size) to 
+            give each member its own value.
+
+        Returns
+            str: The particle's name.
+        """
+        layout = self.data_layout
+        metadata = layout.particle_metadata
+        for prop_name in props:
+            if prop_name not in metadata.prop_name_to_idx:
+                raise ValueError(f"Unknown property \"{prop_name}\"")
+        if name is None:
+            name = layout.fresh_particle_name()
+
+        if layout.num_particles() == self.capacity():
+            self._grow(max(1, 2 * self.capacity()))
+        index = layout.add_particle(name)
+        self._data[..., self._particle_slice(index)] = 0
+
+        for prop_name, values in props.items():
+            prop = layout.prop_view(self._data, prop_name)[..., index, :]
+            values = numpy.asarray(values, dtype=self.dtype)
+            if values.ndim == 1 and prop.ndim == 2 and values.shape[0] != prop.shape[1]:
+                values = values[:, None] # One value per ensemble member
+            prop[...] = values
+
+        self.spawned.add(name)
+        self.despawned.discard(name)
+        return name
+
+
+    def despawn(self, name):
+        """
+        Remove a particle. The last particle takes its index. Amortized O(1).
+        """
+        index, last = self.data_layout.remove_particle(name)
+        if index != last:
+            self._data[..., self._particle_slice(index)] = self._data[..., self._particle_slice(last)]
+        self._data[..., self._particle_slice(last)] = 0
+        if name in self.spawned:
+            self.spawned.discard(name)
+        else:
+            self.despawned.add(name)
+
+
+    def _particle_slice(self, index):
+        particle_size = self.data_layout.particle_size()
+        return slice(index * particle_size, (index + 1) * particle_size)
+
+
+    def _grow(self, capacity):
+        """Reallocate the data arrays with room for `capacity` particles."""
+        self._data = self._grown(self._data, capacity)
+        self._fresh_data = self._grown(self._fresh_data, capacity)
+
+
+    def _grown(self, array, capacity):
+        grown = numpy.zeros(array.shape[:-1] + (capacity * self.data_layout.particle_size(),), 
+                            dtype=array.dtype)
+        grown[..., :array.shape[-1]] = array
+        return grown
+
+
+    def _set_data(self, data):
+        """Replace the data arrays with `data` (and scratch arrays to match)."""
+        self._data = data
+        self._fresh_data = numpy.zeros_like(data)
+
+
+    def time(self):
+        """Time elapsed since the start of the simulation."""
+        return self._time
     
 
     def positions(self):
@@ -55,20 +203,165 @@ class SimState:
             yield self._data[idxs]
 
 
-    def step(self, dt, t, steps=1):
+    def positions_view(self):
+        """
+        Positions of all particles as a (num_particles, dim) array. The array 
+        is a view of the simulation data, so it tracks the simulation as it 
+        steps (until particles are spawned or despawned). Copy it to keep a 
+        snapshot.
+        """
+        return self.data_layout.prop_view(self._data, "pos")
+
+
+    def step(self, dt, t=None, steps=1):
         """
         Iterates the state of the simulation.
 
         Args
             dt: Time elapsed between steps.
-            t: Time since the start of the simulation.
+            t: Time since the start of the simulation. Defaults to the 
+            state's own time counter.
             steps: Number of times to iterate the simulation state.
         """
         # Step `steps` times.
         for _ in range(steps):
-            self._step_once(dt, t)
+            self._step_once(dt, self._time if t is None else t)
+            self._time += dt
+
+
+    def checkpoint(self, path):
+        """
+        Write the raw simulation data, the data layout, the time counter and 
+        the hash of the script to a binary checkpoint at `path`.
+        """
+        header = {
+            "sim_state_class": sim_state_class_name(type(self)),
+            "time": self._time,
+            "script_hash": checkpoint.script_hash(self.script),
+            "script": self.script,
+            "script_dir": self.script_dir,
+            "options": self.options,
+            "data_layout": self.data_layout.describe(),
+            "spawned": sorted(self.spawned),
+            "despawned": sorted(self.despawned),
+        }
+        checkpoint.write_checkpoint(path, self.data(), header)
+
+
+    @classmethod
+    def restore(cls, path, script=None, script_dir=None):
+        """
+        Resume a simulation from a checkpoint written by `checkpoint`. The 
+        simulation data is memory-mapped (copy-on-write), so the checkpoint 
+        file is never modified.
+
+        Args
+            path: Checkpoint file path.
+            script: The script the checkpoint was created from. Defaults to 
+            the copy stored in the checkpoint. 
+            script_dir: Directory to read the files named in the script from 
+            (see `create_simulation`). The directory stored in the checkpoint 
+            is only a record of where it was written, and is never read.
+
+        Returns
+            SimState: The restored simulation.
+        """
+        header, data = checkpoint.read_checkpoint(path)
+
+        if script is None:
+            script = header["script"]
+        elif checkpoint.script_hash(script) != header["script_hash"]:
+            raise ValueError("Script does not match the checkpoint's script hash")
+        if script is None:
+            raise ValueError(f"Checkpoint \"{path}\" does not contain a script")
+
+        state = create_simulation(script, header["sim_state_class"], 
+                                  script_dir=script_dir, 
+                                  **header["options"])
+        particle_names = header["data_layout"]["particle_names"]
+        if state.data_layout.particle_metadata.particle_names != particle_names:
+            # Particles were spawned or despawned before the checkpoint.
+            state.data_layout.set_particle_names(particle_names)
+        state.spawned = set(header.get("spawned", []))
+        state.despawned = set(header.get("despawned", []))
+        if state.data_layout.describe() != header["data_layout"]:
+            raise ValueError("Checkpoint data layout does not match the script")
+
+        state._set_data(data)
+        state._time = header["time"]
+        return state
 
     
+    def reload(self, script, builder=None):
+        """
+        Switch to an edited version of the simulation's script, without 
+        losing its current state. Functions are recompiled, and the data is 
+        moved to the new script's layout: properties of particles that are 
+        in both scripts keep their current values, while new particles and 
+        properties start from the values in `script`.
+
+        Call this between steps, from the thread that steps the simulation 
+        (see `SimulationProducer.reload` otherwise).
+
+        Args
+            script: The edited script.
+            builder: A `SimulationBuilder` to compile `script` with (e.g. 
+            the one that built this state, so unchanged functions aren't 
+            compiled again).
+        """
+        self.apply_reload(self.prepare_reload(script, builder))
+
+
+    def prepare_reload(self, script, builder=None):
+        """
+        The expensive half of `reload`, which doesn't touch this state: 
+        build `script` with this state's class and options.
+        """
+        new_state = create_simulation(script, sim_state_class_name(type(self)), 
+                                      builder=builder, script_dir=self.script_dir, 
+                                      **self.options)
+        self.carry_over_particles(new_state)
+        return new_state
+
+
+    def carry_over_particles(self, new_state):
+        """
+        Spawn the particles this state spawned, and despawn the particles it 
+        despawned, in `new_state` (a state built from an edited script). 
+        Particles that are already there, or already gone, are left alone.
+        """
+        names = new_state.data_layout.particle_metadata.particle_name_to_idx
+        for name in sorted(self.spawned):
+            if name not in names:
+                new_state.spawn(name)
+        for name in sorted(self.despawned):
+            if name in names:
+                new_state.despawn(name)
+
+
+    def apply_reload(self, new_state):
+        """
+        The cheap half of `reload`: move the current data into 
+        `new_state`'s layout, and adopt its functions. Spawned particles are 
+        kept, and despawned particles stay gone (see `carry_over_particles`).
+        """
+        self.carry_over_particles(new_state)
+        new_state.data_layout.migrate_data(new_state._data, self.data_layout, self._data)
+        self._adopt(new_state)
+
+
+    def _adopt(self, other):
+        """Take the script, layout and data of `other`, a freshly built state."""
+        self.script = other.script
+        self.script_dir = other.script_dir
+        self.files = other.files
+        self.data_layout = other.data_layout
+        self._data = other._data
+        self._fresh_data = other._fresh_data
+        self.spawned = other.spawned
+        self.despawned = other.despawned
+
+
     def _step_once(self, dt, t):
         """See `step`"""
         raise NotImplementedError
@@ -76,18 +369,144 @@ class SimState:
         
 
 class SimStatePythonLambdas(SimState):
-    def __init__(self, particles: list, forces: list, updates: list):
-        super().__init__(particles, forces, updates)
+    # Cumulative `StepProfile`, or None when profiling is disabled.
+    _profile = None
+
+    def __init__(self, particles: list, forces: list, updates: list, 
+                 dtype="float64", accumulator_dtype=None, kernel_cache=None, 
+                 vector_kernels=False, fuse_pair_forces=False):
+        """
+        Args
+            kernel_cache: See `FuncHandler`.
+            vector_kernels: Compile each vector rule to one function, rather 
+            than one function per coordinate (see `FuncHandler`).
+            fuse_pair_forces: Compile all pair forces to one function (see 
+            `FuncHandler`).
+        """
+        super().__init__(particles, forces, updates, dtype, accumulator_dtype)
+        if vector_kernels:
+            self.options["vector_kernels"] = True
+        if fuse_pair_forces:
+            self.options["fuse_pair_forces"] = True
         # Manages functions as python lambdas.
-        self.func_handler = func_handler.FuncHandler(forces, updates, self.data_layout)
+        self.func_handler = func_handler.FuncHandler(forces, updates, self.data_layout,
+                                                     kernel_cache=kernel_cache,
+                                                     vector_kernels=vector_kernels,
+                                                     fuse_pair_forces=fuse_pair_forces)
+        self._allocate_accumulator()
+
+
+    def _allocate_accumulator(self):
+        # Forces are summed here when `accumulator_dtype` is set.
+        self._accumulator = None
+        if self.accumulator_dtype is not None:
+            self._accumulator = numpy.zeros(self._data.shape, 
+                                            dtype=self.accumulator_dtype)
+
+
+    def _grow(self, capacity):
+        """Overridden"""
+        super()._grow(capacity)
+        self._allocate_accumulator()
+
+
+    def _set_data(self, data):
+        """Overridden"""
+        super()._set_data(data)
+        self._allocate_accumulator()
+
+
+    def _begin_forces(self):
+        """
+        The array forces are added to: the simulation data, or the 
+        accumulator, loaded with the current values of the force outputs.
+        """
+        if self._accumulator is None:
+            return self._kernel_data(self._data)
+        indices = self._force_output_indices()
+        self._accumulator[..., indices] = self._data[..., indices]
+        return self._kernel_data(self._accumulator)
+
+
+    def _end_forces(self):
+        """Store the accumulated forces (if any) in the simulation data."""
+        if self._accumulator is None:
+            return
+        indices = self._force_output_indices()
+        self._data[..., indices] = self._accumulator[..., indices]
+
+
+    def _force_output_indices(self):
+        """Indices of every particle's force outputs in the simulation data."""
+        outps = numpy.asarray(self.func_handler.force_output_offsets(), dtype=int)
+        offsets = numpy.arange(self.data_layout.num_particles()) * self.data_layout.particle_size()
+        return (offsets[:, None] + outps[None, :]).ravel()
+
+
+    def enable_profiling(self, hook=None):
+        """
+        Start attributing the time spent in `step` to each force, update rule 
+        and phase (see `profiling.py`). While profiling is disabled, the only 
+        cost is one check per step.
+
+        Args
+            hook: If not None, called after every step with that step's 
+            `StepProfile`.
+        """
+        names = (self.func_handler.force_names, self.func_handler.update_names)
+        self._profile = profiling.StepProfile(*names)
+        self._step_profile = profiling.StepProfile(*names)
+        self._profile_hook = hook
+
+
+    def _adopt(self, other):
+        """Overridden"""
+        super()._adopt(other)
+        self.func_handler = other.func_handler
+        self._accumulator = other._accumulator
+        if self._profile is not None:
+            self.enable_profiling(self._profile_hook)
+
+
+    def disable_profiling(self):
+        self._profile = None
+        self._step_profile = None
+        self._profile_hook = None
+
+
+    def profile(self):
+        """The cumulative `StepProfile` since profiling was enabled, or None."""
+        return self._profile
+
+
+    def contact_counts(self):
+        """
+        The number of candidate pairs and of pairs in contact found by the 
+        last step's collision detection, as `{"candidates", "contacts"}` (see 
+        `FuncHandler.compute_collisions`). Ensembles sum both over members.
+        """
+        return dict(self.func_handler.contact_counts)
 
 
     def _step_once(self, dt, t):
         """Overridden"""
-        self._compute_step(dt, t)
-        self._refresh_data()
-        # Zero out net-force.
-        self._data[self.data_layout.prop_idx_all_particles("net_force")] = 0
+        profile = self._step_profile if self._profile is not None else None
+        if profile is not None:
+            profile.reset()
+            profile.steps = 1
+        phase = profiling.phase_timer(profile)
+
+        self._compute_step(dt, t, profile)
+        with phase("refresh"):
+            self._refresh_data()
+        with phase("zero"):
+            # Zero out net-force.
+            self.data_layout.prop_view(self._data, "net_force")[...] = 0
+
+        if profile is not None:
+            self._profile.add(profile)
+            if self._profile_hook is not None:
+                self._profile_hook(profile)
         
 
     def _refresh_data(self):
@@ -98,57 +517,366 @@ class SimStatePythonLambdas(SimState):
         indices = self._fresh_data != 0
         self._data[indices] = self._fresh_data[indices]
         self._fresh_data[:] = 0
+
+
+    def _kernel_data(self, data):
+        """
+        The array passed to the compiled functions. Functions read and write 
+        it with `data[index]`, where `index` is an index into a single 
+        simulation's data.
+        """
+        return data
     
 
-    def _compute_step(self, dt, t):
+    def _compute_step(self, dt, t, profile=None):
+        """
+        Compute the forces, and the updates (into `_fresh_data`).
+
+        Args
+            profile: If not None, a `StepProfile` to time each phase and 
+            function call into.
+        """
         num_particles = self.data_layout.num_particles()
-        # Compute forces.
+        data = self._kernel_data(self._data)
+        fresh_data = self._kernel_data(self._fresh_data)
+        phase = profiling.phase_timer(profile)
+        force_wrap = update_wrap = None
+        if profile is not None:
+            force_wrap, update_wrap = profile.timed_force, profile.timed_update
+        pair_forces, single_forces = self.func_handler.split_forces(force_wrap)
+        update_rules = self.func_handler.update_rules(update_wrap)
+
+        forces_data = self._begin_forces()
+        # Compute reductions (once per step, for every particle).
+        with phase("reductions"):
+            self.func_handler.compute_reductions(num_particles, dt, data)
+        with phase("pair_forces"):
+            self._compute_pair_forces(pair_forces, num_particles, forces_data, data)
+        with phase("bonds"):
+            # Only between the listed pairs.
+            self.func_handler.compute_bonds(forces_data, data)
+        with phase("collisions"):
+            # Only between particles in contact.
+            self.func_handler.compute_collisions(num_particles, forces_data, data)
+            if profile is not None:
+                profile.add_counts(self.func_handler.contact_counts)
+        with phase("forces"):
+            self._compute_single_forces(single_forces, num_particles, forces_data, data)
+            self._end_forces()
+        with phase("updates"):
+            self._compute_updates(update_rules, num_particles, dt, data, fresh_data)
+
+
+    def _compute_pair_forces(self, pair_forces, num_particles, forces_data, data):
+        """Add the forces between every two particles to `forces_data`."""
+        if not pair_forces:
+            return
+        particle_size = self.data_layout.particle_size()
         for i in range(num_particles):
+            offset = particle_size * i
             for j in range(num_particles):
                 if i == j: continue # DON'T FORGET THIS
 
+                # Compute the force between particles i and j, and apply 
+                # to particle i.
+                for force, outp, width in pair_forces:
+                    if width is None:
+                        forces_data[offset + outp] += force(i, j, data) 
+                    else:
+                        # A vector kernel: all coordinates at once.
+                        index = offset + outp
+                        for value in force(i, j, data):
+                            forces_data[index] += value
+                            index += 1
+
+
+    def _compute_single_forces(self, single_forces, num_particles, forces_data, data):
+        """Add the forces on each particle to `forces_data`."""
+        particle_size = self.data_layout.particle_size()
+        for i in range(num_particles):
+            offset = particle_size * i
+            # Compute the forces on particle i.
+            for force, outp, width in single_forces:
+                if width is None:
+                    forces_data[offset + outp] += force(i, data) 
+                else:
+                    index = offset + outp
+                    for value in force(i, data):
+                        forces_data[index] += value
+                        index += 1
+
+
+    def _compute_updates(self, update_rules, num_particles, dt, data, fresh_data):
+        """Compute the updated properties of each particle into `fresh_data`."""
+        particle_size = self.data_layout.particle_size()
+        for i in range(num_particles):
+            offset = particle_size * i
+            # Update properties for particle i based on the net force, and dt.
+            for update_rule, outp, width in update_rules:
+                if width is None:
+                    fresh_data[offset + outp] = update_rule(i, dt, data)
+                else:
+                    index = offset + outp
+                    for value in update_rule(i, dt, data):
+                        fresh_data[index] = value
+                        index += 1
+
+
+class SimStateEnsemble(SimStatePythonLambdas):
+    """
+    `ensemble_size` copies ("members") of a simulation, stepped together. The 
+    data is an (ensemble_size, sim_size) array, and each compiled function 
+    evaluates all members at once.
+
+    Members may start from different initial conditions, and may use 
+    different values for literals in the script's functions.
+    """
+    def __init__(self, particles: list, forces: list, updates: list, 
+                 ensemble_size=1, properties=None, literals=None, 
+                 dtype="float64", accumulator_dtype=None, kernel_cache=None, 
+                 vector_kernels=False, fuse_pair_forces=False):
+        """
+        Args
+            ensemble_size: Number of members.
+            properties: Per-member property values, as 
+            `{particle_name: {prop_name: values}}`. `values` has shape 
+            (ensemble_size,) or (ensemble_size, prop_size), or is a scalar.
+            literals: Per-member literal values, as `{literal: values}`, 
+            where `literal` is the literal as written in the script (e.g. 
+            "6.674e-11") and `values` has shape (ensemble_size,). Every 
+            occurrence of the literal is replaced.
+            vector_kernels, fuse_pair_forces: See `SimStatePythonLambdas`.
+        """
+        SimState.__init__(self, particles, forces, updates, dtype, accumulator_dtype)
+        self.ensemble_size = ensemble_size
+        self._data = numpy.tile(self._data, (ensemble_size, 1))
+        self._fresh_data = numpy.zeros_like(self._data)
+
+        properties = properties or {}
+        literals = literals or {}
+        self.options.update({
+            "ensemble_size": ensemble_size,
+            "properties": {
+                particle_name: {prop_name: numpy.asarray(values).tolist() 
+                                for prop_name, values in props.items()}
+                for particle_name, props in properties.items()},
+            "literals": {literal: numpy.asarray(values).tolist() 
+                         for literal, values in literals.items()},
+        })
+        if vector_kernels:
+            self.options["vector_kernels"] = True
+        if fuse_pair_forces:
+            self.options["fuse_pair_forces"] = True
+
+        metadata = self.data_layout.particle_metadata
+        for particle_name, props in properties.items():
+            particle_idx = metadata.particle_name_to_idx[particle_name]
+            for prop_name, values in props.items():
+                values = numpy.asarray(values, dtype=self._data.dtype)
+                if values.ndim == 1:
+                    values = values[:, None]
+                prop = self.data_layout.prop_view(self._data, prop_name)
+                prop[:, particle_idx, :] = values
+
+        # Row `p` of `params` holds every member's value of the `p`th literal.
+        literal_names = sorted(literals)
+        self._params = numpy.zeros((len(literal_names), ensemble_size), dtype=self.dtype)
+        for row, literal in enumerate(literal_names):
+            self._params[row] = literals[literal]
+
+        self.func_handler = func_handler.FuncHandler(
+                forces, updates, self.data_layout, 
+                compiler_options={
+                    "vectorize": True,
+                    "literal_params": {literal: row for row, literal in enumerate(literal_names)},
+                },
+                namespace={"params": self._params},
+                kernel_cache=kernel_cache,
+                vector_kernels=vector_kernels,
+                fuse_pair_forces=fuse_pair_forces)
+        self._allocate_accumulator()
+
+
+    def _adopt(self, other):
+        """Overridden"""
+        super()._adopt(other)
+        self._params = other._params
 
-                # Compute the force between particles i and j, and apply to 
-                # particle i.
-                for force, index in self.func_handler.forces(i):
-                    signature = inspect.signature(force)
-                    number_of_arguments = len(signature.parameters)
-                    if (number_of_arguments == 3):
-                        self._data[index] += force(i, j, self._data) 
-        
 
-        # Compute forces (2).
-        for i in range(num_particles):
-            # Compute the force between particles i and j, and apply to 
-            # particle i.
-            for force, index in self.func_handler.forces(i):
+    def _kernel_data(self, data):
+        """
+        Overridden. The transpose of the data, so that `data[index]` selects 
+        `index` in every member.
+        """
+        return data.T
 
-                signature = inspect.signature(force)
-                number_of_arguments = len(signature.parameters)
 
-                if (number_of_arguments == 2):
-                    self._data[index] += force(i, self._data) 
+def float_dtype(dtype):
+    """`dtype` as a numpy floating point dtype."""
+    dtype = numpy.dtype(dtype)
+    if not numpy.issubdtype(dtype, numpy.floating):
+        raise ValueError(f"Expected a floating point dtype, got \"{dtype}\"")
+    return dtype
 
-        #time.sleep(1)
-        #print(self.data_layout.state_str(self.data()))
 
+# Maps names accepted by `create_simulation` to `SimState` subclasses.
+SIM_STATE_CLASSES = {
+    "python-lambdas": SimStatePythonLambdas,
+    "ensemble": SimStateEnsemble,
+}
 
 
-        # Compute and apply updates.
-        for i in range(num_particles):
-            # Update properties for particle i based on the net force, and dt.
-            for update_rule, index in self.func_handler.updates(i):
-                self._fresh_data[index] = update_rule(i, dt, self._data)
+def sim_state_class_name(sim_state_class):
+    """Inverse of `SIM_STATE_CLASSES`."""
+    for name, cls in SIM_STATE_CLASSES.items():
+        if cls is sim_state_class:
+            return name
+    raise Exception(f"Unregistered SimState subclass \"{sim_state_class.__name__}\"")
 
 
 # FIXME: This should probably move.
-def create_simulation(script, sim_state_class="python-lambdas"):
-    """Builds a `SimState` object from a syzygy script."""
-    # Parse
-    ast_builder = parse.AstBuilder()
-    tree = ast_builder.build_entire_ast(script)
+def create_simulation(script, sim_state_class="python-lambdas", cache_dir=None, 
+                      startup_report=None, builder=None, script_dir=None, 
+                      **options):
+    """
+    Builds a `SimState` object from a syzygy script. `options` are passed to 
+    the `SimState` subclass (e.g. `ensemble_size` for "ensemble").
+
+    If `cache_dir` is given, compiled simulations are pickled there, and 
+    later calls with the same script, class and options (from any process) 
+    unpickle them instead of parsing and compiling again.
+
+    If `startup_report` (a `profiling.StartupReport`) is given, the time 
+    spent in each phase of building the simulation is recorded there.
+
+    If `builder` (a `SimulationBuilder`) is given, it parses and compiles the 
+    script, reusing whatever it built for earlier versions of it.
+
+    Files named in the script (e.g. bond pairs) are read relative to 
+    `script_dir`. Scripts that read files are rejected if it is None, so 
+    leave it out for scripts from untrusted sources.
+    """
+    if sim_state_class not in SIM_STATE_CLASSES:
+        raise Exception(f"Unknown SimState subclass \"{sim_state_class}\"")
 
-    if sim_state_class == "python-lambdas":
-        return SimStatePythonLambdas(tree["particles"], tree["forces"], tree["updates"])
-    else:
+    if startup_report is not None:
+        with profiling.collecting(startup_report):
+            return create_simulation(script, sim_state_class, cache_dir, 
+                                     builder=builder, script_dir=script_dir, 
+                                     **options)
+
+    if cache_dir is not None:
+        # Pickles made by another version of the generated code aren't used.
+        key = json.dumps([func_handler.PICKLE_VERSION, script, script_dir, 
+                          sim_state_class, options], 
+                         sort_keys=True, 
+                         default=lambda value: numpy.asarray(value).tolist())
+        cache_path = os.path.join(cache_dir, checkpoint.script_hash(key) + ".pkl")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as reader:
+                state = pickle.load(reader)
+            # Files the script read may have changed since it was cached.
+            if not files_changed(state.files):
+                report = profiling.startup_report()
+                if report is not None:
+                    report.count("cache_hits")
+                return state
+        state = create_simulation(script, sim_state_class, builder=builder, 
+                                  script_dir=script_dir, **options)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename, so other processes never see a partial file.
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as writer:
+            pickle.dump(state, writer)
+        os.replace(temp_path, cache_path)
+        return state
+
+    if builder is not None:
+        return builder.create_simulation(script, sim_state_class, 
+                                         script_dir=script_dir, **options)
+
+    # Parse. (Imported here, so simulations can be loaded and stepped without 
+    # the parser.)
+    from syzygy.parse import parse
+    ast_builder = parse.AstBuilder()
+    tree = ast_builder.build_entire_ast(script, script_dir)
+
+    return build_simulation(tree, script, sim_state_class, script_dir=script_dir, 
+                            **options)
+
+
+def files_changed(files):
+    """
+    Whether any of `files` (paths mapped to the SHA-256 of their contents, 
+    see `SimState.files`) has changed or gone.
+    """
+    for path, digest in files.items():
+        try:
+            with open(path, "rb") as reader:
+                if hashlib.sha256(reader.read()).hexdigest() != digest:
+                    return True
+        except OSError:
+            return True
+    return False
+
+
+def build_simulation(tree, script, sim_state_class="python-lambdas", 
+                     kernel_cache=None, script_dir=None, **options):
+    """
+    Builds a `SimState` object from a script that has already been parsed 
+    (see `AstBuilder.build_entire_ast`). Parsing is the expensive part of 
+    `create_simulation`, and parsed trees can be pickled, so this is the 
+    cheap way to build many simulations from one script.
+
+    `kernel_cache` is passed to the state's `FuncHandler`. `script_dir` is 
+    the directory the tree was parsed with (see `create_simulation`).
+    """
+    if sim_state_class not in SIM_STATE_CLASSES:
         raise Exception(f"Unknown SimState subclass \"{sim_state_class}\"")
+
+    state = SIM_STATE_CLASSES[sim_state_class](tree["particles"], tree["forces"], 
+                                               tree["updates"], 
+                                               kernel_cache=kernel_cache, **options)
+    state.script = script
+    state.script_dir = script_dir
+    state.files = dict(tree.get("files", {}))
+    return state
+
+
+class SimulationBuilder:
+    """
+    Builds simulations from successive versions of a script (e.g. while a 
+    script is being edited). The grammar is loaded once, and statements and 
+    functions that are unchanged since an earlier build are not parsed, 
+    shaped or compiled again. Functions are recompiled when the properties 
+    they read are moved (i.e. when the set of properties changes).
+
+    Only what the last script built uses is kept, so a long editing session 
+    doesn't accumulate the statements and kernels of every version.
+    """
+    def __init__(self):
+        from syzygy.parse import parse
+        self.ast_builder = parse.AstBuilder(incremental=True)
+        self.kernel_cache = {}
+        # Builds may run on other threads (e.g. reloads of a running 
+        # simulation), one at a time.
+        self._lock = threading.Lock()
+
+
+    def build_tree(self, script, script_dir=None):
+        """See `AstBuilder.build_entire_ast`."""
+        return self.ast_builder.build_entire_ast(script, script_dir)
+
+
+    def create_simulation(self, script, sim_state_class="python-lambdas", 
+                          script_dir=None, **options):
+        """See `create_simulation`."""
+        with self._lock:
+            tree = self.build_tree(script, script_dir)
+            state = build_simulation(tree, script, sim_state_class, 
+                                     kernel_cache=self.kernel_cache, 
+                                     script_dir=script_dir, **options)
+            # Forget the kernels this script doesn't use.
+            self.kernel_cache = {key: self.kernel_cache[key] 
+                                 for key in state.func_handler.used_kernels}
+        return state
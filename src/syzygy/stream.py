@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+#
+#
+# Binary encoding of position frames for streaming to browsers (see
+# `web.py`).
+#
+# Every frame starts with a fixed header:
+#
+#   offset  type      field
+#   0       4 bytes   MAGIC
+#   4       uint8     encoding (ENCODING_*)
+#   5       uint8     dim
+#   6       uint16    reserved (0)
+#   8       uint32    sequence number
+#   12      uint32    num_particles
+#   16      float64   simulation time
+#
+# followed by the payload:
+#
+#   ENCODING_FLOAT32    num_particles * dim float32 positions
+#   ENCODING_QUANT16    dim float32 origin, float32 scale, then
+#                       num_particles * dim int16 grid coordinates
+#   ENCODING_DELTA16    num_particles * dim int16 differences from the
+#                       previous frame's grid coordinates. Uses the origin
+#                       and scale of the last ENCODING_QUANT16 frame (the
+#                       keyframe).
+#
+# A quantised position is `origin + scale * q`. All fields are little-endian.
+
+import struct
+
+import numpy
+
+
+MAGIC = b"SYZF"
+HEADER = struct.Struct("<4sBBHIId")
+
+ENCODING_FLOAT32 = 0
+ENCODING_QUANT16 = 1
+ENCODING_DELTA16 = 2
+
+_QUANT_MAX = 32767
+
+
+class FrameEncoder:
+    def __init__(self, quantise=False, delta=False, keyframe_every=30):
+        """
+        Args
+            quantise: Send positions as int16 coordinates on a grid spanning
+            the particles' bounding box, rather than as float32.
+            delta: Send quantised positions as differences from the previous
+            frame. Requires `quantise`. Deltas are small, so they compress
+            well (e.g. with websocket permessage-deflate).
+            keyframe_every: With `delta`, send a full quantised frame at least
+            this often.
+        """
+        if delta and not quantise:
+            raise ValueError("Delta encoding requires quantisation")
+        self.quantise = quantise
+        self.delta = delta
+        self.keyframe_every = keyframe_every
+        self._origin = None
+        self._scale = None
+        self._prev = None
+        self._since_keyframe = 0
+
+
+    def reset(self):
+        """Make the next frame a keyframe."""
+        self._prev = None
+
+
+    def encode(self, positions, seq, t):
+        """Encode a (num_particles, dim) position array."""
+        num_particles, dim = positions.shape
+
+        if not self.quantise:
+            header = HEADER.pack(MAGIC, ENCODING_FLOAT32, dim, 0, seq, num_particles, t)
+            return header + positions.astype("<f4").tobytes()
+
+        if self._prev is not None and self._since_keyframe < self.keyframe_every:
+            q = self._quantise(positions)
+            if q is not None and numpy.abs(q - self._prev).max() <= _QUANT_MAX:
+                delta = (q - self._prev).astype("<i2")
+                self._prev = q
+                self._since_keyframe += 1
+                header = HEADER.pack(MAGIC, ENCODING_DELTA16, dim, 0, seq, num_particles, t)
+                return header + delta.tobytes()
+
+        # Keyframe: fit the grid to the current bounding box.
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+        # Rounded to float32 up front, so the decoder's grid matches exactly.
+        self._origin = ((low + high) / 2).astype(numpy.float32).astype(numpy.float64)
+        scale = max(float((high - low).max()) / (2 * _QUANT_MAX), 1e-30)
+        self._scale = float(numpy.float32(scale * (1 + 1e-6)))
+        q = self._quantise(positions)
+        self._prev = q if self.delta else None
+        self._since_keyframe = 0
+
+        header = HEADER.pack(MAGIC, ENCODING_QUANT16, dim, 0, seq, num_particles, t)
+        grid = self._origin.astype("<f4").tobytes() + struct.pack("<f", self._scale)
+        return header + grid + q.astype("<i2").tobytes()
+
+
+    def _quantise(self, positions):
+        """Grid coordinates of `positions`, or None if any is out of range."""
+        q = numpy.rint((positions - self._origin) / self._scale)
+        if numpy.abs(q).max() > _QUANT_MAX:
+            return None
+        return q.astype(numpy.int32)
+
+
+
+class FrameDecoder:
+    """Inverse of `FrameEncoder`. Mirrors the browser client in `web.py`."""
+    def __init__(self):
+        self._origin = None
+        self._scale = None
+        self._prev = None
+
+
+    def decode(self, frame):
+        """
+        Returns
+            tuple[int, float, numpy.ndarray]: The sequence number, the
+            simulation time and the (num_particles, dim) positions.
+        """
+        magic, encoding, dim, _, seq, num_particles, t = HEADER.unpack_from(frame)
+        if magic != MAGIC:
+            raise ValueError("Not a syzygy frame")
+        offset = HEADER.size
+        count = num_particles * dim
+
+        if encoding == ENCODING_FLOAT32:
+            positions = numpy.frombuffer(frame, "<f4", count, offset)
+            return seq, t, positions.reshape(num_particles, dim).astype(numpy.float64)
+
+        if encoding == ENCODING_QUANT16:
+            self._origin = numpy.frombuffer(frame, "<f4", dim, offset).astype(numpy.float64)
+            self._scale, = struct.unpack_from("<f", frame, offset + 4 * dim)
+            offset += 4 * dim + 4
+            q = numpy.frombuffer(frame, "<i2", count, offset).astype(numpy.int32)
+        elif encoding == ENCODING_DELTA16:
+            if self._prev is None:
+                raise ValueError("Delta frame received before a keyframe")
+            q = self._prev + numpy.frombuffer(frame, "<i2", count, offset)
+        else:
+            raise ValueError(f"Unknown frame encoding {encoding}")
+
+        self._prev = q
+        positions = self._origin + self._scale * q.reshape(num_particles, dim)
+        return seq, t, positions
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+#
+# Parameter sweeps: run a script template over a grid of parameters on a pool
+# of worker processes.
+#
+# The template is a syzygy script with `$name` (or `${name}`) placeholders,
+# filled in from each point of the grid. The grid entries `dt` and `steps`
+# may also vary the run itself rather than the script.
+#
+# Each distinct script is compiled once, in this process, by one 
+# `SimulationBuilder` (so statements shared between scripts are only parsed 
+# and compiled once). Workers receive the
+# pickled simulations when they start, and unpickle a fresh copy for each run
+# (which only re-evaluates the generated functions).
+#
+# Results go to `out_dir`:
+#
+#   * `sweep.json`: the template and the grid
+#   * `results.jsonl`: one summary per finished run, written as runs finish
+#   * `<run id>/`: positions recorded by each run (see `runner.run`)
+#
+# Running a sweep again with the same `out_dir` skips the runs already
+# recorded as "ok" in `results.jsonl`. A run's id covers everything that 
+# decides its result (the filled-in script, `dt`, `steps` and the backend), 
+# so runs of an edited template or with other settings are not skipped.
+
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import string
+import traceback
+
+from syzygy import runner
+from syzygy.sim import checkpoint
+from syzygy.sim import sim_state
+
+
+RUN_PARAMS = ("dt", "steps")
+
+
+def grid_points(grid):
+    """
+    The cartesian product of a parameter grid.
+
+    Args
+        grid: A dict mapping parameter names to lists of values.
+
+    Returns
+        list[dict]: One dict of parameter values per point.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_id(params, script_hash, dt, steps, backend):
+    """
+    A stable name for the run with parameters `params`, of the script with 
+    hash `script_hash`, for `steps` steps of `dt` with `backend`.
+    """
+    key = json.dumps([params, script_hash, dt, steps, backend], sort_keys=True)
+    return "run-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+def completed_runs(results_path):
+    """Ids of the runs recorded as successful in `results_path`."""
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path, "r") as reader:
+        for line in reader:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Truncated by an interrupted sweep
+            if result.get("status") == "ok":
+                completed.add(result["id"])
+    return completed
+
+
+# Pickled simulations, keyed by script hash. Set in each worker by 
+# `_init_worker`.
+_compiled = {}
+
+
+def _init_worker(compiled):
+    global _compiled
+    _compiled = compiled
+
+
+def _run_one(script_hash, run, params, dt, steps, record_dir, record_every):
+    """Run one point of the sweep, with id `run` (in a worker process)."""
+    result = {"id": run, "params": params}
+    try:
+        state = pickle.loads(_compiled[script_hash])
+        summary = runner.run(state, dt, steps, record_dir=record_dir,
+                             record_every=record_every)
+        result.update(summary)
+        result["status"] = "ok"
+    except Exception:
+        result["status"] = "error"
+        result["error"] = traceback.format_exc()
+    return result
+
+
+def sweep(template, grid, out_dir, dt=None, steps=None, backend="python-lambdas",
+          record=True, record_every=1, workers=None, on_result=None, 
+          script_dir=None):
+    """
+    Run `template` at every point of `grid`.
+
+    Args
+        template: A script with `$name` placeholders.
+        grid: A dict mapping parameter names to lists of values.
+        out_dir: Output directory (see the top of this module).
+        dt: Time elapsed between steps, unless the grid has a `dt` entry.
+        steps: Number of steps, unless the grid has a `steps` entry.
+        backend: `SimState` backend.
+        record: Whether to record each run's positions.
+        record_every: Record positions once every `record_every` steps.
+        workers: Number of worker processes (default: one per CPU).
+        on_result: Called with each run's summary as it finishes.
+        script_dir: Directory to read files named in the template from (see 
+        `create_simulation`).
+
+    Returns
+        list[dict]: The summaries of the runs performed by this call.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "sweep.json"), "w") as writer:
+        json.dump({"template": template, "grid": grid, "dt": dt, "steps": steps,
+                   "backend": backend}, writer, indent=2)
+
+    results_path = os.path.join(out_dir, "results.jsonl")
+    completed = completed_runs(results_path)
+
+    # Fill in the template, and compile each distinct script once.
+    compiled = {}
+    builder = None
+    runs = []
+    for params in grid_points(grid):
+        script_params = {k: v for k, v in params.items() if k not in RUN_PARAMS}
+        script = string.Template(template).substitute(script_params)
+        script_hash = checkpoint.script_hash(script)
+
+        run_dt = params.get("dt", dt)
+        run_steps = params.get("steps", steps)
+        if run_dt is None or run_steps is None:
+            raise ValueError("`dt` and `steps` must be given, or be in the grid")
+        run_dt, run_steps = float(run_dt), int(run_steps)
+        run = run_id(params, script_hash, run_dt, run_steps, backend)
+        if run in completed:
+            continue
+
+        if script_hash not in compiled:
+            if builder is None:
+                builder = sim_state.SimulationBuilder()
+            compiled[script_hash] = pickle.dumps(
+                    sim_state.create_simulation(script, backend, builder=builder, 
+                                                script_dir=script_dir))
+
+        record_dir = os.path.join(out_dir, run) if record else None
+        runs.append((script_hash, run, params, run_dt, run_steps,
+                     record_dir, record_every))
+
+    results = []
+    if not runs:
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(compiled,)) as executor, \
+            open(results_path, "a") as results_writer:
+        futures = [executor.submit(_run_one, *run) for run in runs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results_writer.write(json.dumps(result) + "\n")
+            results_writer.flush()
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
+    return results
+
+
+def parse_param(text):
+    """
+    Parse a command line grid entry, `name=v1,v2,...`. Values are read as
+    JSON where possible (so numbers stay numbers), and as strings otherwise.
+    """
+    name, sep, values = text.partition("=")
+    if not sep or not name:
+        raise ValueError(f"Expected NAME=V1,V2,..., got \"{text}\"")
+    parsed = []
+    for value in values.split(","):
+        try:
+            parsed.append(json.loads(value))
+        except json.JSONDecodeError:
+            parsed.append(value)
+    return name, parsed
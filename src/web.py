@@ -1,251 +1,415 @@
 """
-================
-Embedding WebAgg
-================
-
-This example demonstrates how to embed Matplotlib WebAgg interactive plotting
-in your own web application and framework.  It is not necessary to do all this
-if you merely want to display a plot in a browser or use Matplotlib's built-in
-Tornado-based server "on the side".
-
-The framework being used must support web sockets.
+=========================
+Syzygy simulation server
+=========================
+
+Runs syzygy scripts on the server and streams particle positions to
+browsers over websockets, as compact binary frames (see `syzygy.stream`).
+Browsers draw the particles themselves, so bandwidth and server CPU scale
+with the number of particles rather than with the size of a rendered image.
+
+    python3 src/web.py --workers 4 --max-particle-steps 1e6
+
+Users submit scripts from the index page (or POST them to `/sessions`), and
+may PUT an edited script to `/sessions/<id>` to reload it without losing the
+session's state.
+Each script becomes a session, run by a pool of worker processes
+(`syzygy.sessions`); sessions that would exceed the particle-steps budget are
+rejected. Every tick, the latest frame of each session is sent to each of its
+subscribers that has finished receiving the previous one; slower clients
+skip frames instead of buffering them.
+
+Scripts given on the command line are submitted at startup:
+
+    python3 src/web.py tests/scripts/solar_system_lite.txt --dt 3600 \\
+        --steps-per-frame 100
 """
 
 import argparse
-import io
 import json
-import mimetypes
-from pathlib import Path
 import signal
 import socket
 
 try:
     import tornado
 except ImportError as err:
-    raise RuntimeError("This example requires tornado.") from err
+    raise RuntimeError("This server requires tornado.") from err
+import tornado.escape
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 import tornado.websocket
 
-import numpy as np
+from syzygy import sessions
+from syzygy import stream
 
-import matplotlib as mpl
-from matplotlib.backends.backend_webagg import (
-    FigureManagerWebAgg, new_figure_manager_given_figure)
-from matplotlib.figure import Figure
 
+ENCODINGS = {
+    "float32": {"quantise": False, "delta": False},
+    "quant16": {"quantise": True, "delta": False},
+    "delta": {"quantise": True, "delta": True},
+}
 
-def create_figure():
-    """
-    Creates a simple example figure.
-    """
-    fig = Figure()
-    ax = fig.add_subplot(projection='3d')
-    t = np.arange(0.0, 3.0, 0.01)
-    s = np.sin(3 * np.pi * t)
-    ax.plot(t, s)
-    return fig
+
+# The index page: submits a script, then opens the session's page.
+index_content = """<!DOCTYPE html>
+<html lang="en">
+  <head>
+    <title>syzygy</title>
+    <style>
+      body { background: #111; color: #ccc; font: 13px monospace; margin: 16px; }
+      textarea { width: 100%%; height: 60vh; background: #000; color: #ccc; }
+      #error { color: #f66; white-space: pre-wrap; }
+    </style>
+  </head>
+  <body>
+    <textarea id="script" spellcheck="false"></textarea>
+    <p>
+      dt <input id="dt" value="0.01" size="8">
+      steps per frame <input id="steps_per_frame" value="1" size="5">
+      fps <input id="fps" value="30" size="4">
+      encoding <select id="encoding">%(encodings)s</select>
+      <button id="submit">Run</button>
+    </p>
+    <div id="error"></div>
+    <script>
+      document.getElementById("submit").onclick = function() {
+        var body = {
+          script: document.getElementById("script").value,
+          dt: parseFloat(document.getElementById("dt").value),
+          steps_per_frame: parseInt(document.getElementById("steps_per_frame").value),
+          fps: parseFloat(document.getElementById("fps").value)
+        };
+        fetch("sessions", {method: "POST", body: JSON.stringify(body)})
+          .then(function(response) {
+            return response.json().then(function(reply) {
+              if (!response.ok) throw new Error(reply.error);
+              var encoding = document.getElementById("encoding").value;
+              window.location = "sessions/" + reply.id + "?encoding=" + encoding;
+            });
+          })
+          .catch(function(err) {
+            document.getElementById("error").textContent = err.message;
+          });
+      };
+    </script>
+  </body>
+</html>
+"""
 
 
-# The following is the content of the web page.  You would normally
-# generate this using some sort of template facility in your web
-# framework, but here we just use Python string formatting.
+# A session's page: a minimal client that decodes frames (the
+# inverse of `syzygy.stream.FrameEncoder`) and draws the particles on a
+# canvas. Drag to rotate, scroll to zoom.
 html_content = """<!DOCTYPE html>
 <html lang="en">
   <head>
-    <!-- TODO: There should be a way to include all of the required javascript
-               and CSS so matplotlib can add to the set in the future if it
-               needs to. -->
-    <link rel="stylesheet" href="_static/css/page.css" type="text/css">
-    <link rel="stylesheet" href="_static/css/boilerplate.css" type="text/css">
-    <link rel="stylesheet" href="_static/css/fbm.css" type="text/css">
-    <link rel="stylesheet" href="_static/css/mpl.css" type="text/css">
-    <script src="mpl.js"></script>
-
+    <title>syzygy</title>
+    <style>
+      html, body { margin: 0; height: 100%%; background: #111; overflow: hidden; }
+      canvas { display: block; }
+      #status { position: absolute; top: 4px; left: 8px; color: #aaa;
+                font: 12px monospace; }
+    </style>
+  </head>
+  <body>
+    <canvas id="canvas"></canvas>
+    <div id="status"></div>
     <script>
-      /* This is a callback that is called when the user saves
-         (downloads) a file.  Its purpose is really to map from a
-         figure and file format to a url in the application. */
-      function ondownload(figure, format) {
-        window.open('download.' + format, '_blank');
-      };
+      var canvas = document.getElementById("canvas");
+      var ctx = canvas.getContext("2d");
+      var statusLine = document.getElementById("status");
+
+      var positions = null, dim = 3, count = 0, time = 0;
+      var origin = null, scale = 1, grid = null;
+      var extent = 0, yaw = 0.6, pitch = 0.4, zoom = 1;
 
-      function ready(fn) {
-        if (document.readyState != "loading") {
-          fn();
+      function resize() {
+        canvas.width = window.innerWidth;
+        canvas.height = window.innerHeight;
+      }
+      window.addEventListener("resize", resize);
+      resize();
+
+      function decode(buffer) {
+        var view = new DataView(buffer);
+        var encoding = view.getUint8(4);
+        dim = view.getUint8(5);
+        count = view.getUint32(12, true);
+        time = view.getFloat64(16, true);
+        var offset = %(header_size)d, n = count * dim, i;
+        if (positions === null || positions.length !== n) {
+          positions = new Float64Array(n);
+        }
+        if (encoding === %(float32)d) {
+          var raw = new Float32Array(buffer.slice(offset, offset + 4 * n));
+          for (i = 0; i < n; i++) positions[i] = raw[i];
+          return;
+        }
+        if (encoding === %(quant16)d) {
+          origin = new Float32Array(buffer.slice(offset, offset + 4 * dim));
+          scale = view.getFloat32(offset + 4 * dim, true);
+          offset += 4 * dim + 4;
+          grid = new Int32Array(n);
+          for (i = 0; i < n; i++) grid[i] = view.getInt16(offset + 2 * i, true);
+        } else if (encoding === %(delta16)d && grid !== null) {
+          for (i = 0; i < n; i++) grid[i] += view.getInt16(offset + 2 * i, true);
         } else {
-          document.addEventListener("DOMContentLoaded", fn);
+          return;
+        }
+        for (i = 0; i < n; i++) {
+          positions[i] = origin[i %% dim] + scale * grid[i];
         }
       }
 
-      ready(
-        function() {
-          /* It is up to the application to provide a websocket that the figure
-             will use to communicate to the server.  This websocket object can
-             also be a "fake" websocket that underneath multiplexes messages
-             from multiple figures, if necessary. */
-          var websocket_type = mpl.get_websocket_type();
-          var websocket = new websocket_type("%(ws_uri)sws");
-
-          // mpl.figure creates a new figure on the webpage.
-          var fig = new mpl.figure(
-              // A unique numeric identifier for the figure
-              %(fig_id)s,
-              // A websocket object (or something that behaves like one)
-              websocket,
-              // A function called when a file type is selected for download
-              ondownload,
-              // The HTML element in which to place the figure
-              document.getElementById("figure"));
+      function draw() {
+        ctx.fillStyle = "#111";
+        ctx.fillRect(0, 0, canvas.width, canvas.height);
+        if (positions === null) return;
+        if (extent === 0) {
+          for (var k = 0; k < positions.length; k++) {
+            extent = Math.max(extent, Math.abs(positions[k]));
+          }
+          extent = extent || 1;
         }
-      );
-    </script>
-
-    <title>matplotlib</title>
-  </head>
+        var cy = Math.cos(yaw), sy = Math.sin(yaw);
+        var cp = Math.cos(pitch), sp = Math.sin(pitch);
+        var s = zoom * 0.45 * Math.min(canvas.width, canvas.height) / extent;
+        ctx.fillStyle = "#9cf";
+        for (var p = 0; p < count; p++) {
+          var x = positions[p * dim], y = positions[p * dim + 1];
+          var z = dim > 2 ? positions[p * dim + 2] : 0;
+          var u = cy * x - sy * y;
+          var v = cp * z - sp * (sy * x + cy * y);
+          ctx.fillRect(canvas.width / 2 + s * u - 2, canvas.height / 2 - s * v - 2, 4, 4);
+        }
+        statusLine.textContent = count + " particles, t = " + time.toExponential(3);
+      }
 
-  <body>
-    <div id="figure">
-    </div>
+      var dragging = null;
+      canvas.addEventListener("mousedown", function(e) { dragging = [e.clientX, e.clientY]; });
+      window.addEventListener("mouseup", function() { dragging = null; });
+      window.addEventListener("mousemove", function(e) {
+        if (dragging === null) return;
+        yaw += 0.01 * (e.clientX - dragging[0]);
+        pitch += 0.01 * (e.clientY - dragging[1]);
+        dragging = [e.clientX, e.clientY];
+      });
+      canvas.addEventListener("wheel", function(e) {
+        zoom *= e.deltaY < 0 ? 1.1 : 1 / 1.1;
+        e.preventDefault();
+      });
+
+      var websocket = new WebSocket(%(ws_uri)s);
+      websocket.binaryType = "arraybuffer";
+      websocket.onmessage = function(event) { decode(event.data); };
+      canvas.addEventListener("dblclick", function() {
+        websocket.send(JSON.stringify({type: "toggle_pause"}));
+      });
+
+      function frame() { draw(); window.requestAnimationFrame(frame); }
+      window.requestAnimationFrame(frame);
+    </script>
   </body>
 </html>
 """
 
 
-class MyApplication(tornado.web.Application):
-    class MainPage(tornado.web.RequestHandler):
+class SimulationApplication(tornado.web.Application):
+    class IndexPage(tornado.web.RequestHandler):
         """
-        Serves the main HTML page.
+        Serves the script submission page.
         """
 
         def get(self):
-            manager = self.application.manager
-            ws_uri = f"ws://{self.request.host}/"
-            content = html_content % {
-                "ws_uri": ws_uri, "fig_id": manager.num}
-            self.write(content)
+            options = "".join(f"<option>{name}</option>" for name in sorted(ENCODINGS))
+            self.write(index_content % {"encodings": options})
 
-    class MplJs(tornado.web.RequestHandler):
+    class Sessions(tornado.web.RequestHandler):
         """
-        Serves the generated matplotlib javascript file.  The content
-        is dynamically generated based on which toolbar functions the
-        user has defined.  Call `FigureManagerWebAgg` to get its
-        content.
+        Creates a session from a JSON body: {"script", "dt", and optionally
+        "steps_per_frame", "fps", "backend"}. Replies with the session's id.
         """
 
-        def get(self):
-            self.set_header('Content-Type', 'application/javascript')
-            js_content = FigureManagerWebAgg.get_javascript()
-
-            self.write(js_content)
-
-    class Download(tornado.web.RequestHandler):
+        async def post(self):
+            manager = self.application.manager
+            try:
+                request = json.loads(self.request.body)
+                backend = request.get("backend", "python-lambdas")
+                # Compile off the IOLoop, so that frames keep going out.
+                state, builder = await tornado.ioloop.IOLoop.current().run_in_executor(
+                        None, manager.compile, request["script"], backend)
+                session = manager.create(
+                        request["script"],
+                        float(request["dt"]),
+                        steps_per_frame=int(request.get("steps_per_frame", 1)),
+                        fps=float(request.get("fps", 30)),
+                        backend=backend,
+                        state=state,
+                        builder=builder)
+            except sessions.AdmissionError as err:
+                self.set_status(429)
+                self.write({"error": str(err)})
+                return
+            except (sessions.SessionError, KeyError, ValueError, TypeError) as err:
+                self.set_status(400)
+                self.write({"error": str(err)})
+                return
+            self.write({"id": session.id})
+
+    class SessionPage(tornado.web.RequestHandler):
         """
-        Handles downloading of the figure in various file formats.
+        Serves a session's page, reloads the session's script (PUT, with a
+        JSON body: {"script"}), or closes the session.
         """
 
-        def get(self, fmt):
+        def get(self, session_id):
+            if int(session_id) not in self.application.manager.sessions:
+                raise tornado.web.HTTPError(404)
+            encoding = self.get_argument("encoding", "float32")
+            if encoding not in ENCODINGS:
+                raise tornado.web.HTTPError(400)
+            ws_uri = f"ws://{self.request.host}/sessions/{session_id}/ws?encoding={encoding}"
+            content = html_content % {
+                # A JavaScript string literal (`json_encode` also escapes "</").
+                "ws_uri": tornado.escape.json_encode(ws_uri),
+                "header_size": stream.HEADER.size,
+                "float32": stream.ENCODING_FLOAT32,
+                "quant16": stream.ENCODING_QUANT16,
+                "delta16": stream.ENCODING_DELTA16,
+            }
+            self.write(content)
+
+        async def put(self, session_id):
             manager = self.application.manager
-            self.set_header(
-                'Content-Type', mimetypes.types_map.get(fmt, 'binary'))
-            buff = io.BytesIO()
-            manager.canvas.figure.savefig(buff, format=fmt)
-            self.write(buff.getvalue())
+            session = manager.sessions.get(int(session_id))
+            if session is None:
+                raise tornado.web.HTTPError(404)
+            try:
+                request = json.loads(self.request.body)
+                state, _ = await tornado.ioloop.IOLoop.current().run_in_executor(
+                        None, manager.compile, request["script"], session.backend, 
+                        session.builder)
+                if session.id not in manager.sessions:
+                    raise tornado.web.HTTPError(404) # Closed while compiling
+                manager.reload(session.id, request["script"], state=state)
+            except (sessions.SessionError, KeyError, ValueError) as err:
+                self.set_status(400)
+                self.write({"error": str(err)})
+
+        def delete(self, session_id):
+            self.application.manager.close(int(session_id))
 
     class WebSocket(tornado.websocket.WebSocketHandler):
         """
-        A websocket for interactive communication between the plot in
-        the browser and the server.
-
-        In addition to the methods required by tornado, it is required to
-        have two callback methods:
-
-            - ``send_json(json_content)`` is called by matplotlib when
-              it needs to send json to the browser.  `json_content` is
-              a JSON tree (Python dictionary), and it is the responsibility
-              of this implementation to encode it as a string to send over
-              the socket.
-
-            - ``send_binary(blob)`` is called to send binary image data
-              to the browser.
+        Streams one session's frames to one browser. Each socket has its own
+        encoder, since delta frames depend on what that client has already
+        received.
         """
-        supports_binary = True
 
-        def open(self):
-            # Register the websocket with the FigureManager.
+        def get_compression_options(self):
+            # permessage-deflate; delta frames are mostly small integers.
+            return {}
+
+        def open(self, session_id):
+            self.session_id = int(session_id)
             manager = self.application.manager
-            manager.add_web_socket(self)
+            if self.session_id not in manager.sessions:
+                self.close(code=1008, reason="No such session")
+                return
+            encoding = self.get_argument("encoding", "float32")
+            self.encoder = stream.FrameEncoder(**ENCODINGS.get(encoding, ENCODINGS["float32"]))
+            # Future for the frame currently being sent, if any.
+            self.pending = None
+            manager.subscribe(self.session_id, self.send_frame)
             if hasattr(self, 'set_nodelay'):
                 self.set_nodelay(True)
 
         def on_close(self):
-            # When the socket is closed, deregister the websocket with
-            # the FigureManager.
-            manager = self.application.manager
-            manager.remove_web_socket(self)
+            self.application.manager.unsubscribe(self.session_id, self.send_frame)
 
         def on_message(self, message):
-            # The 'supports_binary' message is relevant to the
-            # websocket itself.  The other messages get passed along
-            # to matplotlib as-is.
-
-            # Every message has a "type" and a "figure_id".
             message = json.loads(message)
-            if message['type'] == 'supports_binary':
-                self.supports_binary = message['value']
-            else:
-                manager = self.application.manager
-                manager.handle_json(message)
-
-        def send_json(self, content):
-            self.write_message(json.dumps(content))
-
-        def send_binary(self, blob):
-            if self.supports_binary:
-                self.write_message(blob, binary=True)
-            else:
-                data_uri = ("data:image/png;base64," +
-                            blob.encode('base64').replace('\n', ''))
-                self.write_message(data_uri)
-
-    def __init__(self, figure):
-        self.figure = figure
-        self.manager = new_figure_manager_given_figure(id(figure), figure)
+            manager = self.application.manager
+            session = manager.sessions.get(self.session_id)
+            if session is not None and message.get("type") == "toggle_pause":
+                if session.paused:
+                    manager.resume(self.session_id)
+                else:
+                    manager.pause(self.session_id)
+
+        def send_frame(self, positions, seq, t):
+            """Send a frame, unless the previous one is still being sent."""
+            if self.pending is not None and not self.pending.done():
+                # Drop this frame. The next delta must then be relative to
+                # the last frame the client actually got, so start over
+                # from a keyframe.
+                self.encoder.reset()
+                return
+            try:
+                self.pending = self.write_message(
+                        self.encoder.encode(positions, seq, t), binary=True)
+            except tornado.websocket.WebSocketClosedError:
+                self.application.manager.unsubscribe(self.session_id, self.send_frame)
+
+    def __init__(self, manager, fps=30):
+        self.manager = manager
+        self._poller = tornado.ioloop.PeriodicCallback(manager.poll, 1000 / fps)
 
         super().__init__([
-            # Static files for the CSS and JS
-            (r'/_static/(.*)',
-             tornado.web.StaticFileHandler,
-             {'path': FigureManagerWebAgg.get_static_file_path()}),
-
-            # Static images for the toolbar
-            (r'/_images/(.*)',
-             tornado.web.StaticFileHandler,
-             {'path': Path(mpl.get_data_path(), 'images')}),
+            # Script submission
+            ('/', self.IndexPage),
+            ('/sessions', self.Sessions),
 
-            # The page that contains all of the pieces
-            ('/', self.MainPage),
+            # A session's page
+            (r'/sessions/([0-9]+)', self.SessionPage),
 
-            ('/mpl.js', self.MplJs),
+            # Sends a session's frames to the browser, and receives control
+            # messages
+            (r'/sessions/([0-9]+)/ws', self.WebSocket),
+        ])
 
-            # Sends images and events to the browser, and receives
-            # events from the browser
-            ('/ws', self.WebSocket),
+    def start(self):
+        self._poller.start()
 
-            # Handles the downloading (i.e., saving) of static images
-            (r'/download.([a-z0-9.]+)', self.Download),
-        ])
+    def stop(self):
+        self._poller.stop()
+        self.manager.shutdown()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument('scripts', nargs='*',
+                        help='Scripts to run at startup.')
+    parser.add_argument('--dt', type=float, default=0.01,
+                        help='Time elapsed between steps (startup scripts).')
+    parser.add_argument('--steps-per-frame', type=int, default=1,
+                        help='Number of steps between frames (startup scripts).')
+    parser.add_argument('--fps', type=float, default=30,
+                        help='Frames per second sent to clients.')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of simulation worker processes.')
+    parser.add_argument('--max-particle-steps', type=float, default=1e6,
+                        help='Admission limit on total particle-steps per second.')
+    parser.add_argument('--idle-timeout', type=float, default=300,
+                        help='Close sessions without subscribers after this many seconds.')
     parser.add_argument('-p', '--port', type=int, default=8080,
                         help='Port to listen on (0 for a random port).')
     args = parser.parse_args()
 
-    figure = create_figure()
-    application = MyApplication(figure)
+    manager = sessions.SessionManager(workers=args.workers,
+                                      max_particle_steps=args.max_particle_steps,
+                                      idle_timeout=args.idle_timeout)
+    application = SimulationApplication(manager, fps=args.fps)
+
+    startup_sessions = []
+    for path in args.scripts:
+        with open(path, "r") as reader:
+            session = manager.create(reader.read(), args.dt,
+                                     steps_per_frame=args.steps_per_frame,
+                                     fps=args.fps)
+        startup_sessions.append((path, session.id))
 
     http_server = tornado.httpserver.HTTPServer(application)
     sockets = tornado.netutil.bind_sockets(args.port, '')
@@ -256,11 +420,14 @@ if __name__ == "__main__":
         if s.family is socket.AF_INET6:
             addr = f'[{addr}]'
         print(f"Listening on http://{addr}:{port}/")
+    for path, session_id in startup_sessions:
+        print(f"  {path}: /sessions/{session_id}")
     print("Press Ctrl+C to quit")
 
-    ioloop = tornado.ioloop.IOLoop.instance()
+    ioloop = tornado.ioloop.IOLoop.current()
 
     def shutdown():
+        application.stop()
         ioloop.stop()
         print("Server stopped")
 
@@ -269,6 +436,7 @@ if __name__ == "__main__":
         lambda sig, frame: ioloop.add_callback_from_signal(shutdown))
 
     try:
+        application.start()
         ioloop.start()
     finally:
         signal.signal(signal.SIGINT, old_handler)